@@ -0,0 +1,26 @@
+"""
+Command-line helpers shared by the scripts (`train.py`, `test.py`, the sweeps...),
+kept apart so that parsing the arguments doesn't import any of them.
+"""
+
+def get_option(args, name, default=None):
+
+    # Returns the value that follows `name` in the command-line arguments (or `default`)
+
+    if name in args:
+        return args[args.index(name) + 1]
+    return default
+
+def get_selection(args):
+
+    # Returns the slice of the dataset asked in the command-line ("--categories A,B", "--path-prefix P", "--sample N"),
+    # as keyword arguments of `Dataset.select`
+
+    categories = get_option(args, "--categories")
+    sample = get_option(args, "--sample")
+
+    return {
+        "categories" : categories.split(",") if categories is not None else None,
+        "path_prefix" : get_option(args, "--path-prefix"),
+        "sample" : int(sample) if sample is not None else None
+    }
@@ -0,0 +1,281 @@
+# This script measures the dataset and conversion paths (`Dataset.__init__`, `Dataset.to_coco`, `Dataset.write_coco`, `Dataset.to_pascal`,
+# `coco2pascal.create_annotations` and `coco2pascal.create_imageset`) on synthetic datasets of several sizes.
+# Everything runs offline on the CPU: the images are tiny placeholders (hard links to a single JPEG file).
+# Usage: python3 benchmarks/benchmark_dataset.py --scales 1000 100000 [--compare benchmarks/results/<commit>.json]
+
+import argparse, json, os, platform, shutil, subprocess, sys, time, tracemalloc
+import multiprocessing
+import numpy
+from PIL import Image
+
+# The modules being measured live at the root of the repository:
+repository_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository_root)
+
+from profiling import peak_rss_mb
+
+IMAGE_SIZE = 16 # Width and height of the placeholder images
+IMAGES_PER_FOLDER = 1000
+
+def generate_dataset(directory, annotations_num, annotations_per_image=10, classes_num=10, seed=0):
+
+    # Writes `images/`, `annotations.csv`, `classes.json` and `dataset_info.json` to `directory`.
+    # Nothing is written if the same dataset is already there. Returns the path to `dataset_info.json`.
+
+    parameters = [annotations_num, annotations_per_image, classes_num, seed, IMAGE_SIZE]
+    marker_path = os.path.join(directory, "parameters.json")
+    dataset_info_path = os.path.join(directory, "dataset_info.json")
+    if os.path.isfile(marker_path):
+        with open(marker_path, "r") as f:
+            if json.load(f) == parameters:
+                return dataset_info_path
+        shutil.rmtree(directory)
+    os.makedirs(directory, exist_ok=True)
+
+    # Every image is a hard link to the same tiny JPEG file (a copy where links are not supported):
+    images_num = -(-annotations_num // annotations_per_image)
+    template_path = os.path.join(directory, "template.jpg")
+    Image.new("RGB", (IMAGE_SIZE, IMAGE_SIZE), (127, 127, 127)).save(template_path)
+    images_paths = []
+    for i in range(images_num):
+        relative_path = os.path.join("images", "{:05d}".format(i // IMAGES_PER_FOLDER), "{:08d}.jpg".format(i))
+        image_path = os.path.join(directory, relative_path)
+        if i % IMAGES_PER_FOLDER == 0:
+            os.makedirs(os.path.dirname(image_path), exist_ok=True)
+        try:
+            os.link(template_path, image_path)
+        except OSError:
+            shutil.copyfile(template_path, image_path)
+        images_paths.append(relative_path)
+
+    # Writing the classes and the annotations (random boxes inside the images), in chunks:
+    classes = [ "CATEGORY_{:02d}".format(i) for i in range(classes_num) ]
+    with open(os.path.join(directory, "classes.json"), "w") as f:
+        json.dump({ "__background__" : 0, **{ c : i + 1 for i, c in enumerate(classes) } }, f, indent=4)
+
+    generator = numpy.random.default_rng(seed)
+    with open(os.path.join(directory, "annotations.csv"), "w") as f:
+        for start in range(0, annotations_num, 1 << 20):
+            count = min(1 << 20, annotations_num - start)
+            images = (numpy.arange(start, start + count) // annotations_per_image).tolist()
+            corners = generator.integers(0, IMAGE_SIZE // 2, size=(count, 2))
+            sizes = generator.integers(1, IMAGE_SIZE // 2, size=(count, 2))
+            boxes = numpy.concatenate((corners, corners + sizes), axis=1).tolist()
+            categories = generator.integers(0, classes_num, size=count).tolist()
+            f.write("".join(
+                "{},{},{},{},{},{}\n".format(images_paths[i], *box, classes[c]) for i, box, c in zip(images, boxes, categories)
+            ))
+
+    dataset_info = {
+        "base_directory" : directory,
+        "annotations_csv" : os.path.join(directory, "annotations.csv"),
+        "classes_json" : os.path.join(directory, "classes.json"),
+        "width" : IMAGE_SIZE,
+        "height" : IMAGE_SIZE
+    }
+    with open(dataset_info_path, "w") as f:
+        json.dump({ "TRAIN" : dataset_info, "TEST" : dataset_info }, f, indent=4)
+
+    with open(marker_path, "w") as f:
+        json.dump(parameters, f)
+
+    return dataset_info_path
+
+# Every case is a function (dataset_info_path, work_directory, workers) -> function to measure.
+# The code before the `return` is the setup, and it is not measured.
+
+def case_dataset_parse(dataset_info_path, work_directory, workers):
+    from dataset import Dataset
+    return lambda: Dataset(dataset_info_path, "TEST", use_cache=False)
+
+def case_dataset_cached(dataset_info_path, work_directory, workers):
+    from dataset import Dataset
+    Dataset(dataset_info_path, "TEST", rebuild_cache=True) # Writing the cache
+    return lambda: Dataset(dataset_info_path, "TEST")
+
+def case_to_coco(dataset_info_path, work_directory, workers):
+    from dataset import Dataset
+    dataset = Dataset(dataset_info_path, "TEST")
+    return dataset.to_coco
+
+def case_write_coco(dataset_info_path, work_directory, workers):
+    from dataset import Dataset
+    dataset = Dataset(dataset_info_path, "TEST")
+    return lambda: dataset.write_coco(os.path.join(work_directory, "coco.json"))
+
+def case_create_annotations(dataset_info_path, work_directory, workers):
+    from dataset import Dataset
+    from coco2pascal import create_annotations
+    coco_dataset = Dataset(dataset_info_path, "TEST").to_coco()
+    destination = os.path.join(work_directory, "Annotations")
+    shutil.rmtree(destination, ignore_errors=True)
+    return lambda: create_annotations(coco_dataset, dst=destination, workers=workers)
+
+def case_create_imageset(dataset_info_path, work_directory, workers):
+    from dataset import Dataset
+    from coco2pascal import create_annotations, create_imageset
+    # Writing its own XML files, so the case also runs alone:
+    annotations = os.path.join(work_directory, "imageset_annotations")
+    shutil.rmtree(annotations, ignore_errors=True)
+    create_annotations(Dataset(dataset_info_path, "TEST").to_coco(), dst=annotations, workers=workers)
+    return lambda: create_imageset(annotations, "TEST", os.path.join(work_directory, "ImageSets"))
+
+def case_to_pascal(dataset_info_path, work_directory, workers):
+    from dataset import Dataset
+    dataset = Dataset(dataset_info_path, "TEST")
+    destination = os.path.join(work_directory, "pascal")
+    shutil.rmtree(destination, ignore_errors=True)
+    return lambda: dataset.to_pascal(destination, workers=workers)
+
+def case_to_pascal_incremental(dataset_info_path, work_directory, workers):
+    from dataset import Dataset
+    dataset = Dataset(dataset_info_path, "TEST")
+    # Exporting once (not measured), then again to the same folder with nothing changed:
+    destination = os.path.join(work_directory, "pascal_incremental")
+    shutil.rmtree(destination, ignore_errors=True)
+    dataset.to_pascal(destination, workers=workers)
+    return lambda: dataset.to_pascal(destination, workers=workers)
+
+CASES = {
+    "dataset_parse" : case_dataset_parse,
+    "dataset_cached" : case_dataset_cached,
+    "to_coco" : case_to_coco,
+    "write_coco" : case_write_coco,
+    "create_annotations" : case_create_annotations,
+    "create_imageset" : case_create_imageset,
+    "to_pascal" : case_to_pascal,
+    "to_pascal_incremental" : case_to_pascal_incremental
+}
+
+def measure_case(connection, case, dataset_info_path, work_directory, workers, trace):
+
+    # Runs in a child process, so every case starts with a clean heap and its own peak RSS.
+    # With `trace`, only the Python allocations peak is measured (tracemalloc slows the code down).
+
+    try:
+        function = CASES[case](dataset_info_path, work_directory, workers)
+        if trace:
+            tracemalloc.start()
+            function()
+            result = { "traced_peak_mb" : tracemalloc.get_traced_memory()[1] / (1 << 20) }
+            tracemalloc.stop()
+        else:
+            rss_before = peak_rss_mb()
+            wall, cpu = time.perf_counter(), time.process_time()
+            function()
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            result = { "wall" : wall, "cpu" : cpu, "peak_rss_mb" : peak_rss_mb(), "peak_rss_growth_mb" : peak_rss_mb() - rss_before }
+    except Exception as e:
+        result = { "error" : repr(e) }
+
+    connection.send(result)
+    connection.close()
+
+def run_case(case, dataset_info_path, work_directory, workers, trace):
+
+    context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=measure_case, args=(sender, case, dataset_info_path, work_directory, workers, trace))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = { "error" : "the process died (exit code {})".format(process.join() or process.exitcode) }
+    process.join()
+
+    return result
+
+def environment():
+
+    # Describes the machine and the code being measured
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=repository_root, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = "unknown"
+
+    return {
+        "commit" : commit,
+        "date" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python" : platform.python_version(),
+        "numpy" : numpy.__version__,
+        "platform" : platform.platform(),
+        "cpu_count" : os.cpu_count()
+    }
+
+def compare(baseline, results):
+
+    # Prints the time and memory ratios (current / baseline) of every case measured in both runs
+
+    print("Compared to {} ({}):".format(baseline["environment"]["commit"], baseline["environment"]["date"]))
+    print("{:>12} {:>24} {:>10} {:>10} {:>10}".format("scale", "case", "wall", "rss", "traced"))
+    for scale, cases in results["scales"].items():
+        for case, result in cases.items():
+            base = baseline["scales"].get(scale, {}).get(case)
+            if base is None or "error" in base or "error" in result:
+                continue
+            ratios = [
+                result[key] / base[key] if base.get(key) and key in result else float("nan")
+                for key in ("wall", "peak_rss_growth_mb", "traced_peak_mb")
+            ]
+            print("{:>12} {:>24} {:>9.2f}x {:>9.2f}x {:>9.2f}x".format(scale, case, *ratios))
+
+def get_arguments():
+
+    parser = argparse.ArgumentParser(description="Measures the dataset and conversion paths on synthetic datasets.")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1000, 10000, 100000], help="Numbers of annotations (up to 10M)")
+    parser.add_argument("--annotations-per-image", type=int, default=10, help="Annotations of every synthetic image")
+    parser.add_argument("--classes", type=int, default=10, help="Number of categories")
+    parser.add_argument("--cases", nargs="+", choices=list(CASES.keys()), default=list(CASES.keys()), help="Cases to measure")
+    parser.add_argument("--repeat", type=int, default=1, help="Times every case is measured (the fastest run is kept)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Processes writing the XML files")
+    parser.add_argument("--no-tracemalloc", action="store_true", help="Skips the (slow) Python allocations measurement")
+    parser.add_argument("--data", default=os.path.join(repository_root, "benchmarks", "data"), help="Synthetic datasets directory")
+    parser.add_argument("--output", help="Results file (default: benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", help="Results file of another run, to compare with")
+
+    return parser.parse_args()
+
+def main():
+
+    args = get_arguments()
+    results = { "environment" : environment(), "parameters" : vars(args), "scales" : {} }
+
+    for scale in args.scales:
+        directory = os.path.join(args.data, "{}_annotations".format(scale))
+        print("Generating a dataset with {} annotations...".format(scale))
+        dataset_info_path = generate_dataset(directory, scale, args.annotations_per_image, args.classes)
+        work_directory = os.path.join(directory, "work")
+        os.makedirs(work_directory, exist_ok=True)
+
+        scale_results = results["scales"][str(scale)] = {}
+        for case in args.cases:
+            runs = [ run_case(case, dataset_info_path, work_directory, args.workers, False) for _ in range(args.repeat) ]
+            result = min(runs, key=lambda run: run.get("wall", float("inf")))
+            if not args.no_tracemalloc and "error" not in result:
+                result.update(run_case(case, dataset_info_path, work_directory, args.workers, True))
+            scale_results[case] = result
+
+            if "error" in result:
+                print("{:>12} {:>24}: ERROR {}".format(scale, case, result["error"]))
+            else:
+                print("{:>12} {:>24}: {:9.3f}s wall, {:9.3f}s CPU, +{:.0f} MiB RSS, {} MiB traced".format(
+                    scale, case, result["wall"], result["cpu"], result["peak_rss_growth_mb"],
+                    "{:.0f}".format(result["traced_peak_mb"]) if "traced_peak_mb" in result else "-"
+                ))
+
+    output_path = args.output or os.path.join(repository_root, "benchmarks", "results", "{}.json".format(results["environment"]["commit"]))
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Results saved to {}".format(output_path))
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            compare(json.load(f), results)
+
+if __name__ == "__main__":
+    main()
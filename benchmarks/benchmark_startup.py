@@ -0,0 +1,101 @@
+# This script measures how long the command-line tools take to start: the wall time of `cli.py --help`
+# and of every subcommand's `--help`, and the import time of the entry points and their slowest imports (`python -X importtime`).
+# Usage: python3 benchmarks/benchmark_startup.py [--repeat 5] [--output benchmarks/results/startup_<commit>.json]
+
+import argparse, json, os, subprocess, sys, time
+
+repository_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(repository_root, "benchmarks"))
+from benchmark_dataset import environment
+
+COMMANDS = {
+    "help" : [ "cli.py", "--help" ],
+    "train_help" : [ "cli.py", "train", "--help" ],
+    "test_help" : [ "cli.py", "test", "--help" ],
+    "convert_to_voc_help" : [ "cli.py", "convert-to-voc", "--help" ],
+    "to_coco_help" : [ "cli.py", "to-coco", "--help" ]
+}
+
+# Modules whose import time is measured (the conversions must not pull Detectron2 or PyTorch):
+MODULES = [ "cli", "dataset", "coco2pascal", "train", "inference" ]
+
+def time_command(command, repeat):
+
+    # Returns the fastest wall time (seconds) of `command` out of `repeat` runs, or None if it fails
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run([ sys.executable ] + command, cwd=repository_root, capture_output=True)
+        times.append(time.perf_counter() - start)
+        if process.returncode != 0:
+            return None
+
+    return min(times)
+
+def import_times(module):
+
+    # Returns the import time (seconds) of `module` and of its 5 slowest direct imports,
+    # from the output of `python -X importtime`
+
+    process = subprocess.run(
+        [ sys.executable, "-X", "importtime", "-c", "import " + module ], cwd=repository_root, capture_output=True, text=True
+    )
+    if process.returncode != 0:
+        return { "error" : process.stderr.strip().splitlines()[-1] }
+
+    # The lines are "import time: self | cumulative | name", the name is indented by 2 spaces per nesting level
+    # and a module is listed after everything it imports:
+    total, direct_imports = None, []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            direct_imports.append((name.strip(), int(cumulative) / 1e6))
+        elif depth == 0:
+            if name.strip() == module:
+                total = int(cumulative) / 1e6
+                break
+            direct_imports = [] # Imported by the interpreter start-up, not by `module`
+
+    slowest = sorted(direct_imports, key=lambda item: -item[1])[:5]
+    return { "total" : total, "slowest" : dict(slowest) }
+
+def get_arguments():
+
+    parser = argparse.ArgumentParser(description="Measures the start-up time of the command-line tools.")
+    parser.add_argument("--repeat", type=int, default=5, help="Times every command runs (the fastest run is kept)")
+    parser.add_argument("--output", help="Results file (default: benchmarks/results/startup_<commit>.json)")
+
+    return parser.parse_args()
+
+def main():
+
+    args = get_arguments()
+    results = { "environment" : environment(), "commands" : {}, "imports" : {} }
+
+    for name, command in COMMANDS.items():
+        seconds = results["commands"][name] = time_command(command, args.repeat)
+        print("{:>24}: {}".format(" ".join(command), "failed" if seconds is None else "{:.3f}s".format(seconds)))
+
+    for module in MODULES:
+        result = results["imports"][module] = import_times(module)
+        if "error" in result:
+            print("{:>24}: {}".format("import " + module, result["error"]))
+        else:
+            print("{:>24}: {:.3f}s ({})".format("import " + module, result["total"], ", ".join(
+                "{} {:.3f}s".format(module, seconds) for module, seconds in result["slowest"].items()
+            )))
+
+    output_path = args.output or os.path.join(
+        repository_root, "benchmarks", "results", "startup_{}.json".format(results["environment"]["commit"])
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Results saved to {}".format(output_path))
+
+if __name__ == "__main__":
+    main()
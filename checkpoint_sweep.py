@@ -0,0 +1,144 @@
+# This script evaluates every checkpoint ("model_XXXXXXX.pth" and "model_final.pth") of a training output directory
+# and writes a table comparing them. The dataset and the ground truth are loaded once, and every image is decoded
+# once into an `ImageCache`, so the checkpoints only pay for the inference.
+# Usage: python3 checkpoint_sweep.py dataset_info.json test_info.json output/my_training [--image-cache DIR] [--no-cache] [--rebuild-cache] [--sample N]
+# "CFG_PATH" may be left empty in `test_info.json`, the `cfg.yaml` of the training is used then.
+
+import json, os, re, sys
+
+from detectron2.checkpoint import DetectionCheckpointer
+
+# Our modules:
+from arguments import get_option, get_selection
+from inference import load_dataset, setup_cfg, setup_output_folder, predict
+from evaluation import ArrayEvaluator
+from image_cache import load_or_build_image_cache
+from predictor import BatchPredictor
+from predictions import instances_to_arrays
+from profiling import StageProfiler
+
+def find_checkpoints(training_output_dir):
+
+    # Returns the (iteration, path) of every checkpoint, sorted by iteration ("model_final.pth" is the last one)
+
+    checkpoints = []
+    for file_name in os.listdir(training_output_dir):
+        match = re.fullmatch(r"model_(\d+|final)\.pth", file_name)
+        if match is not None:
+            iteration = float("inf") if match.group(1) == "final" else int(match.group(1))
+            checkpoints.append((iteration, os.path.join(training_output_dir, file_name)))
+
+    return sorted(checkpoints)
+
+def sweep(dataset, cfg, test_info, checkpoints, image_cache, output_folder_path, profiler):
+
+    # Evaluates every checkpoint over the same cached images, returns {checkpoint name : results}
+
+    images = dataset.get()
+    evaluator = ArrayEvaluator(dataset) # The ground truth is read only once
+    score_threshold = test_info["SCORE_THRESH_TEST"]
+
+    def read_image(file_name):
+        return image_cache.get(file_name)[0]
+
+    def on_batch(batch_images, batch_outputs):
+        for image, outputs in zip(batch_images, batch_outputs):
+            boxes, scores, classes = instances_to_arrays(outputs["instances"])
+            keep = scores > score_threshold
+            evaluator.add(evaluator.images_indices[image["file_name"]], boxes[keep], scores[keep], classes[keep])
+
+    predictor = None
+    all_results = {}
+    for _, checkpoint_path in checkpoints:
+        name = os.path.splitext(os.path.basename(checkpoint_path))[0]
+        print("Evaluating {}".format(name))
+
+        # The model is built once, only the weights change between checkpoints:
+        with profiler.stage("load_weights"):
+            if predictor is None:
+                cfg.MODEL.WEIGHTS = checkpoint_path
+                predictor = BatchPredictor(cfg)
+            else:
+                DetectionCheckpointer(predictor.model).load(checkpoint_path)
+
+        evaluator.reset()
+        predict(cfg, test_info, images, on_batch, profiler, predictor=predictor, read_image=read_image)
+        with profiler.stage("native_eval"):
+            results = evaluator.evaluate()
+
+        # Dumping the results in the same files as `test.py`:
+        checkpoint_folder = os.path.join(output_folder_path, name)
+        os.makedirs(checkpoint_folder, exist_ok=True)
+        for metric, metric_results in results.items():
+            with open(os.path.join(checkpoint_folder, "{}_eval_results.json".format(metric)), "w") as results_file:
+                json.dump(metric_results, results_file, indent=2)
+
+        all_results[name] = results
+
+    return all_results
+
+def write_table(checkpoints, results, output_folder_path):
+
+    # Prints the metrics of every checkpoint and saves them as `checkpoint_sweep.csv` and `checkpoint_sweep.json`
+
+    columns = [ ("coco", "AP"), ("coco", "AP50"), ("coco", "AP75"), ("pascal", "AP"), ("pascal", "AP50"), ("pascal", "AP75") ]
+    header = [ "checkpoint", "iteration" ] + [ "{}_{}".format(metric, key) for metric, key in columns ]
+    rows = []
+    for iteration, checkpoint_path in checkpoints:
+        name = os.path.splitext(os.path.basename(checkpoint_path))[0]
+        values = [ float(results[name][metric]["bbox"][key]) for metric, key in columns ]
+        rows.append([ name, "final" if iteration == float("inf") else iteration ] + values)
+
+    with open(os.path.join(output_folder_path, "checkpoint_sweep.csv"), "w") as f:
+        f.write(",".join(header) + "\n")
+        f.write("".join(",".join(str(value) for value in row) + "\n" for row in rows))
+    with open(os.path.join(output_folder_path, "checkpoint_sweep.json"), "w") as f:
+        json.dump([ dict(zip(header, row)) for row in rows ], f, indent=2)
+
+    best = max(rows, key=lambda row: row[2]) # Best COCO AP
+    print("{:>24} {:>10} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}".format("checkpoint", "iteration", "COCO AP", "AP50", "AP75", "VOC AP", "AP50", "AP75"))
+    for row in rows:
+        print("{:>24} {:>10} {:8.2f} {:8.2f} {:8.2f} {:8.2f} {:8.2f} {:8.2f}{}".format(*row, "  <- best" if row is best else ""))
+
+def main(args):
+
+    # Getting the arguments from the command-line:
+    dataset_info_path = args[1]
+    test_info_path = args[2]
+    training_output_dir = args[3]
+    image_cache_dir = get_option(args, "--image-cache") # Directory of the decoded images (default: in the output folder)
+    use_cache = "--no-cache" not in args
+    rebuild_cache = "--rebuild-cache" in args # Also decodes the images again
+
+    with open(test_info_path, "r") as f:
+        test_info = json.load(f)
+    if not test_info.get("CFG_PATH"):
+        test_info["CFG_PATH"] = os.path.join(training_output_dir, "cfg.yaml")
+
+    checkpoints = find_checkpoints(training_output_dir)
+    if not checkpoints:
+        raise FileNotFoundError("No checkpoint found in {}".format(training_output_dir))
+
+    profiler = StageProfiler(test_info.get("PROFILE_STAGE") or None)
+    with profiler.stage("dataset"):
+        dataset, _ = load_dataset(dataset_info_path, use_cache, rebuild_cache, get_selection(args))
+    cfg = setup_cfg(test_info)
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = test_info["SCORE_THRESH_TEST"] # No raw predictions are stored here
+    output_folder_path = os.path.join(setup_output_folder(test_info, cfg), "checkpoint_sweep")
+    os.makedirs(output_folder_path, exist_ok=True)
+
+    # Decoding every image once (the cache is reused by later sweeps too):
+    with profiler.stage("image_cache"):
+        image_cache = load_or_build_image_cache(
+            dataset.get(), image_cache_dir or os.path.join(output_folder_path, "image_cache"),
+            workers=test_info.get("NUM_WORKERS", 4), rebuild=rebuild_cache
+        )
+
+    results = sweep(dataset, cfg, test_info, checkpoints, image_cache, output_folder_path, profiler)
+    write_table(checkpoints, results, output_folder_path)
+
+    profiler.report()
+    profiler.save(os.path.join(output_folder_path, "profile.json"))
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,125 @@
+# One entry point for every tool of the repository. Every subcommand imports only what it needs
+# (Detectron2 and PyTorch are only imported by `train` and `test`), so `--help` and the conversions start fast.
+# Usage: python3 cli.py {train,test,convert-to-voc,to-coco,visualize} ... (see `python3 cli.py SUBCOMMAND --help`)
+
+import argparse, os, sys
+
+repository_root = os.path.dirname(os.path.abspath(__file__))
+
+def run_train(args):
+
+    import train
+    train.main([ "train.py", args.dataset_info, args.train_info ] + cache_flags(args) + selection_flags(args))
+
+def run_test(args):
+
+    import inference
+    argv = [ "test.py", args.dataset_info, args.test_info ] + cache_flags(args) + selection_flags(args)
+    if args.num_shards is not None:
+        argv += [ "--num-shards", str(args.num_shards) ]
+    if args.shard_index is not None:
+        argv += [ "--shard-index", str(args.shard_index) ]
+    if args.merge:
+        argv.append("--merge")
+    inference.main(argv)
+
+def run_convert_to_voc(args):
+
+    dataset = load_dataset(args)
+    dataset.to_pascal(args.destination, workers=args.workers)
+
+def run_to_coco(args):
+
+    dataset = load_dataset(args)
+    dataset.write_coco(args.output) # Streamed, the COCO dataset is never built in memory
+
+def run_visualize(args):
+
+    # The visualizer parses its own arguments
+    sys.path.insert(0, os.path.join(repository_root, "extra_tools"))
+    import prediction_visualizer
+    sys.argv = [ "prediction_visualizer.py" ] + args.arguments
+    prediction_visualizer.main()
+
+def load_dataset(args):
+
+    from dataset import Dataset
+    dataset = Dataset(args.dataset_info, args.type, use_cache=not args.no_cache, rebuild_cache=args.rebuild_cache)
+    categories = args.categories.split(",") if args.categories is not None else None
+    return dataset.select(categories, args.path_prefix, args.sample)
+
+def cache_flags(args):
+    return ([ "--no-cache" ] if args.no_cache else []) + ([ "--rebuild-cache" ] if args.rebuild_cache else [])
+
+def selection_flags(args):
+
+    flags = []
+    for flag, value in (("--categories", args.categories), ("--path-prefix", args.path_prefix), ("--sample", args.sample)):
+        if value is not None:
+            flags += [ flag, str(value) ]
+    return flags
+
+def get_arguments(argv):
+
+    parser = argparse.ArgumentParser(description="Training, testing and conversion tools for Detectron2 datasets.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_cache_arguments(subparser):
+        subparser.add_argument("--no-cache", action="store_true", help="Parses the CSV again without touching the dataset cache")
+        subparser.add_argument("--rebuild-cache", action="store_true", help="Parses the CSV again and overwrites the dataset cache")
+        # Slices of the dataset (e.g. for smoke runs), see `Dataset.select`:
+        subparser.add_argument("--categories", help="Keeps only the images with boxes of these comma-separated categories")
+        subparser.add_argument("--path-prefix", help="Keeps only the images whose path starts with this prefix")
+        subparser.add_argument("--sample", type=int, help="Keeps a random sample of this many images (fixed seed)")
+
+    train_parser = subparsers.add_parser("train", help="Trains a model (same as train.py)")
+    train_parser.add_argument("dataset_info", help="`dataset_info.json` file")
+    train_parser.add_argument("train_info", help="`train_info.json` file")
+    add_cache_arguments(train_parser)
+    train_parser.set_defaults(function=run_train)
+
+    test_parser = subparsers.add_parser("test", help="Predicts and evaluates the test dataset (same as test.py)")
+    test_parser.add_argument("dataset_info", help="`dataset_info.json` file")
+    test_parser.add_argument("test_info", help="`test_info.json` file")
+    test_parser.add_argument("--num-shards", type=int, help="Splits the dataset between this many local worker processes")
+    test_parser.add_argument("--shard-index", type=int, help="Only predicts this shard (worker mode)")
+    test_parser.add_argument("--merge", action="store_true", help="Only merges and evaluates the shards already predicted")
+    add_cache_arguments(test_parser)
+    test_parser.set_defaults(function=run_test)
+
+    voc_parser = subparsers.add_parser("convert-to-voc", help="Exports a dataset to PASCAL VOC (XML files and image sets)")
+    voc_parser.add_argument("dataset_info", help="`dataset_info.json` file")
+    voc_parser.add_argument("destination", help="PASCAL VOC output folder")
+    voc_parser.add_argument("--type", choices=["TRAIN", "TEST"], default="TEST", help="Dataset of `dataset_info.json`")
+    voc_parser.add_argument("--workers", type=int, help="Processes writing the XML files (default: number of CPUs)")
+    add_cache_arguments(voc_parser)
+    voc_parser.set_defaults(function=run_convert_to_voc)
+
+    coco_parser = subparsers.add_parser("to-coco", help="Exports a dataset to a COCO JSON file")
+    coco_parser.add_argument("dataset_info", help="`dataset_info.json` file")
+    coco_parser.add_argument("output", help="COCO JSON output file")
+    coco_parser.add_argument("--type", choices=["TRAIN", "TEST"], default="TEST", help="Dataset of `dataset_info.json`")
+    add_cache_arguments(coco_parser)
+    coco_parser.set_defaults(function=run_to_coco)
+
+    visualize_parser = subparsers.add_parser(
+        "visualize", add_help=False, help="Draws the predictions of test.py (see extra_tools/prediction_visualizer.py)"
+    )
+    visualize_parser.set_defaults(function=run_visualize)
+
+    # Everything after `visualize` goes to the visualizer (its own `--help` included):
+    args, unknown = parser.parse_known_args(argv)
+    if args.command == "visualize":
+        args.arguments = unknown
+    elif unknown:
+        parser.error("unrecognized arguments: {}".format(" ".join(unknown)))
+
+    return args
+
+def main(argv):
+
+    args = get_arguments(argv)
+    args.function(args)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,20 +1,19 @@
 ''' The source of this is script is https://gist.github.com/AlexeyGy/5e9c5a177db31569c20c76ad4dc39284
 and it was authored by https://github.com/AlexeyGy, the access was made at April 27th, 2020.
 '''
+import hashlib
 import json
 import os
+from concurrent.futures import ProcessPoolExecutor
 from cytoolz import merge, join, groupby
 from cytoolz.compatibility import iteritems
 from cytoolz.curried import update_in
 from itertools import starmap
 from collections import deque
 from lxml import etree, objectify
-from scipy.io import savemat
-import imageio
 from pathlib import Path
 from tqdm import tqdm
-
-imread = imageio.imread # The script originally used scipy.imread, but it is deprecated now.
+from image_probe import probe_image
 
 def keyjoin(leftkey, leftseq, rightkey, rightseq):
     return starmap(merge, join(leftkey, leftseq, rightkey, rightseq))
@@ -57,6 +56,7 @@ def instance_to_xml(anno):
 
 
 def write_categories(coco_annotation, dst):
+    from scipy.io import savemat # Only needed here (and slow to import)
     content = coco_annotation
     categories = tuple( d['name'] for d in content['categories'] )
     savemat(os.path.abspath(dst), {'categories': categories})
@@ -100,20 +100,59 @@ def create_imageset(annotations_folder, dataset_type, dst):
     # Creating the directory:
     os.makedirs(dst, exist_ok=True)
 
-    with open(file_path, "w") as f:
-        f.write("") # Cleaning the file
-
     # Creating a blank alternate ImageSet file:
     with open(alt_path, "w") as f:
         f.write("")
 
-    for instance in os.listdir(annotations):
-        file_without_ext, _ = os.path.splitext(instance) # File path without extension
-        with open(file_path, "a") as f:
-            f.write('{}\n'.format(file_without_ext))
+    # Writing every image of the annotations folder in a single pass:
+    lines = [ '{}\n'.format(os.path.splitext(instance)[0]) for instance in sorted(os.listdir(annotations)) ]
+    with open(file_path, "w") as f:
+        f.write("".join(lines))
+
+def annotation_hash(name, group):
+
+    '''
+        Returns a hash of everything that ends up in the XML file of an image:
+        the image path, its size on disk and modification time, and its annotations.
+    '''
+
+    try:
+        stat = os.stat(os.path.abspath(name))
+        image_state = [stat.st_size, stat.st_mtime_ns]
+    except OSError:
+        image_state = None
+
+    content = [name, image_state, [[instance['category_id'], instance['bbox']] for instance in group]]
+    return hashlib.blake2b(json.dumps(content).encode(), digest_size=16).hexdigest()
+
+def load_manifest(manifest_path):
+
+    '''
+        The manifest maps every XML file name to the hash of its content and
+        tells whether the file was written (grayscale images are skipped).
+    '''
 
-def create_annotations(coco_annotation, dst='annotations_voc'):
+    if manifest_path is None or not os.path.isfile(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, "r") as f:
+            return json.load(f)
+    except ValueError:
+        return {} # A broken manifest means every file is rewritten
 
+def save_manifest(manifest, manifest_path):
+
+    temporary_path = manifest_path + ".tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(temporary_path, manifest_path)
+
+def create_annotations(coco_annotation, dst='annotations_voc', workers=None, manifest_path=None):
+
+    '''
+        About manifest_path: if set, only the XML files whose content changed since
+        the last call are written, and the XML files of removed images are deleted.
+    '''
 
     os.makedirs(dst, exist_ok=True)
 
@@ -134,24 +173,71 @@ def create_annotations(coco_annotation, dst='annotations_voc'):
     for i, instance in tqdm(enumerate(instances),desc="rewriting categories"):
         instances[i]['category_id'] = categories[instance['category_id']]
 
-    for name, group in tqdm(iteritems(groupby('file_name', instances)), total=len(groupby('file_name', instances)), desc="processing annotations"):
-        
-        '''
-            About name: the image path
-            About group: the image informations
-        '''
-
-        img = imread(os.path.abspath(name))
-        if img.ndim == 3:
-            out_name = rename(name)
-            image_folder, image_name = os.path.split(out_name)
-            annotation = root(image_folder, '{}.jpg'.format(image_name),  group[0]['height'], group[0]['width'])
-            for instance in group:
-                annotation.append(instance_to_xml(instance))
-
-            # Exporting XML to destination folder
-            destination_file = "{}.xml".format(out_name)
-            _, destination_file = os.path.split(destination_file)
-            xml_file = etree.ElementTree(annotation)
-            xml_file.write(os.path.join(dst, destination_file))
-            
+    groups = groupby('file_name', instances) # Computed only once
+
+    # Finding out which XML files have to be written:
+    old_manifest = load_manifest(manifest_path)
+    manifest = {}
+    tasks = []
+    for name, group in iteritems(groups):
+        xml_name = "{}.xml".format(os.path.split(rename(name))[-1])
+        content_hash = annotation_hash(name, group)
+        old_entry = old_manifest.get(xml_name)
+        if old_entry is not None and old_entry["hash"] == content_hash and \
+                old_entry["written"] == os.path.isfile(os.path.join(dst, xml_name)):
+            manifest[xml_name] = old_entry # Nothing changed
+        else:
+            manifest[xml_name] = { "hash" : content_hash, "written" : False }
+            tasks.append((name, group, dst))
+
+    # Removing the XML files of the images that are not in the dataset anymore:
+    for xml_name, entry in old_manifest.items():
+        if xml_name not in manifest and entry["written"] and os.path.isfile(os.path.join(dst, xml_name)):
+            os.remove(os.path.join(dst, xml_name))
+
+    # Writing the XML files from a pool of processes (or from this process if `workers` is 1):
+    if workers == 1 or len(tasks) < 2:
+        written = [ write_annotation(task) for task in tqdm(tasks, desc="processing annotations") ]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            written = list(tqdm(
+                executor.map(write_annotation, tasks, chunksize=64),
+                total=len(tasks), desc="processing annotations"
+            ))
+
+    for (name, _, _), was_written in zip(tasks, written):
+        manifest["{}.xml".format(os.path.split(rename(name))[-1])]["written"] = was_written
+
+    if manifest_path is not None:
+        save_manifest(manifest, manifest_path)
+
+    return sum(written) # Number of XML files written
+
+def write_annotation(task):
+
+    '''
+        About task: (name, group, dst) tuple, where name is the image path,
+        group is the image informations and dst is the destination folder.
+        Returns True if the XML file was written.
+    '''
+
+    name, group, dst = task
+
+    # Only the image header is read (the image is not decoded):
+    width, height, channels = probe_image(os.path.abspath(name))
+    if channels < 2:
+        return False # Grayscale images are skipped
+
+    out_name = rename(name)
+    image_folder, image_name = os.path.split(out_name)
+    annotation = root(image_folder, '{}.jpg'.format(image_name), width, height)
+    for instance in group:
+        annotation.append(instance_to_xml(instance))
+
+    # Exporting XML to destination folder
+    destination_file = "{}.xml".format(out_name)
+    _, destination_file = os.path.split(destination_file)
+    xml_file = etree.ElementTree(annotation)
+    xml_file.write(os.path.join(dst, destination_file))
+
+    return True
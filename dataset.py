@@ -4,9 +4,30 @@ Detectron2 uses Coco-formated datasets, this file contains everything that
 allow us to outperform this difference.
 """
 
-import json, os
-from coco2pascal import create_annotations, create_imageset
-from detectron2.structures import BoxMode
+import copy, hashlib, json, os
+import numpy
+from image_probe import probe_images
+
+# Detectron2 (`get`) and the PASCAL VOC conversion (`to_pascal`) are only imported when they are used,
+# so reading the dataset and converting it to COCO stay fast to start.
+
+CACHE_VERSION = 1 # Increase it whenever the cached arrays change their meaning
+
+def file_fingerprint(file_path, content_hash=True):
+
+    # Returns a dictionary that identifies the current state of a file
+
+    stat = os.stat(file_path)
+    fingerprint = { "size" : stat.st_size, "mtime" : stat.st_mtime_ns }
+
+    if content_hash:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 24), b""):
+                digest.update(block)
+        fingerprint["hash"] = digest.hexdigest()
+
+    return fingerprint
 
 class Dataset:
 
@@ -33,54 +54,162 @@ class Dataset:
         self.categories_dict = categories_dict
         self.categories_num = len(self.categories_dict)
     
-    def _set_coco_dicts(self):
+    def _read_annotations(self):
 
-        # This function sets a coco-format dictionary.
+        # This function reads the annotation (CSV) file in chunks of lines and
+        # stores it in a columnar way: every image path appears only once and the
+        # annotations are kept as flat NumPy arrays grouped by image.
 
         categories_id = self.categories_dict
 
-        # Getting the CSV file info:
-        with open(self.annotations_file, "r") as f:
-            lines = f.read().strip().split("\n")
+        images_index = {} # Keys are the relative image paths, Values are the image codes
+        codes_chunks, boxes_chunks, categories_chunks = [], [], []
 
-        images_dict = {} # `images_dict` is a dictionary where the index is the image path
-        
-        # Reading the lines of the annotation (CSV) file:
-        for line in lines:
-
-            # Getting the CSV data:
-            info = line.split(",")
-            file_name = os.path.join(self.base_dir, info[0])
-            x0, y0 = int(info[1]), int(info[2])
-            x1, y1 = int(info[3]), int(info[4])
-            category = info[5]
-            width, height = self.dimensions
-
-            # Converting the CSV-format data into COCO-format data
-            annotation = {
-                "bbox" : [x0, y0, x1, y1],
-                "bbox_mode" : BoxMode.XYXY_ABS, # Need to change from string to enum when move to LCAD
-                "category_id" : categories_id[category],
-                "is_crowd" : 0,
+        with open(self.annotations_file, "r") as f:
+            while True:
+
+                # Getting the next chunk of lines of the CSV file:
+                lines = f.readlines(self.chunk_size)
+                if not lines:
+                    break
+                rows = [ line.rstrip("\n").rsplit(",", 5) for line in lines if line.strip() ]
+                if not rows:
+                    continue
+                paths, x0, y0, x1, y1, categories = zip(*rows)
+
+                # Mapping every image path of the chunk to its image code, keeping the
+                # order in which the images first appear in the CSV file:
+                unique_paths, first_rows, inverse = numpy.unique(
+                    numpy.array(paths), return_index=True, return_inverse=True
+                )
+                unique_codes = numpy.empty(len(unique_paths), dtype=numpy.int64)
+                for i in numpy.argsort(first_rows, kind="stable"):
+                    unique_codes[i] = images_index.setdefault(str(unique_paths[i]), len(images_index))
+                codes_chunks.append(unique_codes[inverse.reshape(-1)])
+
+                # Getting the bounding boxes and the categories codes:
+                boxes_chunks.append(numpy.array([ x0, y0, x1, y1 ]).astype(numpy.int32).T)
+                categories_chunks.append(numpy.fromiter(
+                    (categories_id[category.strip()] for category in categories),
+                    dtype=numpy.int32, count=len(categories)
+                ))
+
+        # Sorting the annotations by image (stable, so the CSV order is kept inside every image):
+        if codes_chunks:
+            codes = numpy.concatenate(codes_chunks)
+            order = numpy.argsort(codes, kind="stable")
+            self.boxes = numpy.concatenate(boxes_chunks)[order]
+            self.categories = numpy.concatenate(categories_chunks)[order]
+            counts = numpy.bincount(codes, minlength=len(images_index))
+        else:
+            self.boxes = numpy.empty((0, 4), dtype=numpy.int32)
+            self.categories = numpy.empty(0, dtype=numpy.int32)
+            counts = numpy.empty(0, dtype=numpy.int64)
+
+        # `offsets[i]:offsets[i + 1]` are the annotations of the i-th image:
+        self.offsets = numpy.zeros(len(images_index) + 1, dtype=numpy.int64)
+        numpy.cumsum(counts, out=self.offsets[1:])
+        self.images_paths = numpy.array(list(images_index.keys()), dtype=str)
+
+    def _cache_is_valid(self, cached_fingerprints):
+
+        # A cache entry is valid if both source files are still the same.
+        # Hashing is only needed when the size matches but the mtime changed. If the content is the same
+        # (e.g. after a `touch` or a copy), `cached_fingerprints` gets the new mtime, to be saved again.
+
+        for key, file_path in (("annotations", self.annotations_file), ("classes", self.classes_file)):
+            cached = cached_fingerprints.get(key)
+            current = file_fingerprint(file_path, content_hash=False)
+            if cached is None or cached["size"] != current["size"]:
+                return False
+            if cached["mtime"] != current["mtime"]:
+                current = file_fingerprint(file_path)
+                if cached["hash"] != current["hash"]:
+                    return False
+                cached_fingerprints[key] = current
+
+        return True
+
+    def _load_cache(self):
+
+        # Loads the parsed arrays from the cache file, returns False if it is missing or stale
+
+        if not os.path.isfile(self.cache_file):
+            return False
+
+        try:
+            with numpy.load(self.cache_file, allow_pickle=False) as cache:
+                metadata = json.loads(str(cache["metadata"]))
+                fingerprints = dict(metadata["fingerprints"])
+                if metadata["version"] != CACHE_VERSION or not self._cache_is_valid(fingerprints):
+                    return False
+                self.images_paths = cache["images_paths"]
+                self.offsets = cache["offsets"]
+                self.boxes = cache["boxes"]
+                self.categories = cache["categories"]
+        except (OSError, ValueError, KeyError):
+            return False # A broken cache file is treated like a stale one
+
+        # Same content with a new mtime: saving the new fingerprints, so later runs don't hash the files again
+        if fingerprints != metadata["fingerprints"]:
+            self._save_cache(fingerprints)
+
+        return True
+
+    def _save_cache(self, fingerprints=None):
+
+        # Saves the parsed arrays next to the annotations CSV file
+        # (`fingerprints` : the already computed fingerprints of the source files)
+
+        metadata = {
+            "version" : CACHE_VERSION,
+            "fingerprints" : fingerprints or {
+                "annotations" : file_fingerprint(self.annotations_file),
+                "classes" : file_fingerprint(self.classes_file)
             }
-            if file_name in images_dict.keys():
-                images_dict[file_name]["annotations"].append(annotation)
-            else:
-                images_dict[file_name] = {
-                    "file_name" : file_name,
-                    "height" : height,
-                    "width" : width,
-                    "image_id" : info[0], # Using the relative name of the image as ID
-                    "annotations" : [annotation]
-                }
-
-        images_list = []
-        for key in images_dict.keys():
-            images_list.append(images_dict[key])
+        }
 
-        self.images = images_list
+        # Writing to a temporary file first, so an interrupted write never leaves a broken cache:
+        temporary_file = "{}.{}.tmp".format(self.cache_file, os.getpid())
+        try:
+            with open(temporary_file, "wb") as f:
+                numpy.savez(
+                    f,
+                    metadata=numpy.array(json.dumps(metadata)),
+                    images_paths=self.images_paths,
+                    offsets=self.offsets,
+                    boxes=self.boxes,
+                    categories=self.categories
+                )
+            os.replace(temporary_file, self.cache_file)
+        except OSError:
+            # The cache is only an optimization (e.g. the CSV folder may be read-only):
+            if os.path.exists(temporary_file):
+                os.remove(temporary_file)
+
+    def _image_dict(self, i, bbox_mode):
+
+        # Builds the Detectron2-format dictionary of the i-th image (`bbox_mode` is `BoxMode.XYXY_ABS`).
+
+        relative_path = str(self.images_paths[i])
+        start, end = self.offsets[i], self.offsets[i + 1]
+
+        annotations = [{
+                "bbox" : bbox,
+                "bbox_mode" : bbox_mode, # Need to change from string to enum when move to LCAD
+                "category_id" : category_id,
+                "is_crowd" : 0,
+                } for bbox, category_id in zip(self.boxes[start:end].tolist(), self.categories[start:end].tolist())]
+
+        return {
+            "file_name" : os.path.join(self.base_dir, relative_path),
+            "height" : int(self.heights[i]),
+            "width" : int(self.widths[i]),
+            "image_id" : relative_path, # Using the relative name of the image as ID
+            "annotations" : annotations
+        }
 
-    def __init__(self, settings_file_path, dataset_type):
+    def __init__(self, settings_file_path, dataset_type, chunk_size=1 << 24, use_cache=True, rebuild_cache=False):
 
         # Opening the dataset settings file:
         with open(settings_file_path, "r") as f:
@@ -90,18 +219,40 @@ class Dataset:
         self.base_dir = dataset_info["base_directory"]
         self.annotations_file = dataset_info["annotations_csv"]
         self.classes_file = dataset_info["classes_json"]
-        self.dimensions = dataset_info["width"], dataset_info["height"]
+        self.dimensions = dataset_info.get("width", 0), dataset_info.get("height", 0) # Optional with "probe_sizes"
+        self.chunk_size = chunk_size # Approximate size (in bytes) of every CSV chunk
+        self.cache_file = self.annotations_file + ".cache.npz" # Parsed dataset cache (next to the CSV)
+        self.size_index_file = self.annotations_file + ".sizes.json" # Image sizes index (next to the CSV)
+        self.use_cache, self.rebuild_cache = use_cache, rebuild_cache
 
         # Setting up the dataset
         self._set_categories_id()
-        self._set_coco_dicts()
+        if not use_cache:
+            self._read_annotations()
+        elif rebuild_cache or not self._load_cache():
+            self._read_annotations()
+            self._save_cache()
+
+        # Every image has the size of `dataset_info.json` until `read_image_sizes()` is called
+        # (the number of channels is unknown until then):
+        self.widths = numpy.full(len(self.images_paths), self.dimensions[0], dtype=numpy.int32)
+        self.heights = numpy.full(len(self.images_paths), self.dimensions[1], dtype=numpy.int32)
+        self.channels = None
+        self.indexes = None # Built by the first query (see `_get_indexes`)
+        self.invalidate() # The Detectron2-format dicts and the COCO dataset are only built when needed
+        if dataset_info.get("probe_sizes", False):
+            self.read_image_sizes()
 
         # Setting object variables:
         self.dataset_type = dataset_type
 
     def get(self):
 
-        # Returns the already formated data
+        # Returns the already formated data (built from the arrays on the first call)
+
+        if self.images is None:
+            from detectron2.structures import BoxMode
+            self.images = [ self._image_dict(i, BoxMode.XYXY_ABS) for i in range(len(self.images_paths)) ]
 
         return self.images
 
@@ -109,69 +260,264 @@ class Dataset:
 
         # Returns a list containing the path to every image in the dataset.
 
-        paths = [] # `paths` will contain the image paths
-        
-        # Looking into every image dict:
-        for image in self.images:
-            paths.append(image["file_name"]) # Getting the absolute path in every image
+        return [ os.path.join(self.base_dir, path) for path in self.images_paths.tolist() ]
+
+    def _get_indexes(self):
+
+        # Builds (once) the indexes used by `query`:
+        # "ids" maps the image IDs (relative paths) to the image indices, "categories" maps every category
+        # code to the sorted indices of the images that have it, "sorted_paths" are the image paths in
+        # alphabetical order ("paths_order" are their image indices), for the path prefix queries.
+
+        if self.indexes is None:
+            images_of_annotations = numpy.repeat(numpy.arange(len(self.images_paths)), numpy.diff(self.offsets))
+            paths_order = numpy.argsort(self.images_paths, kind="stable")
+            self.indexes = {
+                "ids" : { path : i for i, path in enumerate(self.images_paths.tolist()) },
+                "categories" : {
+                    code : numpy.unique(images_of_annotations[self.categories == code])
+                    for code in self.categories_dict.values()
+                },
+                "sorted_paths" : self.images_paths[paths_order],
+                "paths_order" : paths_order
+            }
 
-        return paths
+        return self.indexes
 
-    def to_coco(self):
+    def query(self, categories=None, path_prefix=None, image_ids=None, only_categories=False):
 
-        images_ids = {} # Keys are the image name, Values are the IDs
-        images = []
-        annotations = []
-        annotations_counter = 0 # Will be used to get the annotation ID.
-        
-        for image in self.images:
-
-            # Getting the "images" COCO section:
-            images_ids[image["file_name"]] = len(images_ids)
-            images.append({
-                "file_name" : image["file_name"],
-                "height" : image["height"],
-                "width" : image["width"],
-                "id" : images_ids[image["file_name"]]
-            })
-
-            # Getting the "annotations" COCO section:
-            for annotation in image["annotations"]:
-                
-                # COCO uses (x, y, w, h) format, we use (x, y, x, y) format
-                x0, y0, x1, y1 = annotation["bbox"]
-                w, h = x1 - x0, y1 - y0
-
-                annotations.append({
-                    "image_id" : images_ids[image["file_name"]],
-                    "id" : annotations_counter,
-                    "bbox" : [ x0, y0, w, h ],
-                    "area" : w * h,
-                    "iscrowd" : 0,
-                    "category_id" : annotation["category_id"]
-                })
-
-                annotations_counter += 1
-
-        categories = [{
+        # Returns a view (see `view`) of the images that match every given condition:
+        # `categories` : names or codes, the images with at least one annotation of one of them
+        # `path_prefix` : the images whose relative path starts with it (e.g. a sub-directory)
+        # `image_ids` : relative paths of the images
+        # `only_categories` : if True, the view keeps only the annotations of `categories`
+
+        indexes = self._get_indexes()
+        selected = numpy.arange(len(self.images_paths))
+
+        if image_ids is not None:
+            selected = numpy.intersect1d(selected, [ indexes["ids"][image_id] for image_id in image_ids ])
+
+        codes = None
+        if categories is not None:
+            codes = [ self.categories_dict.get(c, c) for c in categories ] # Names are converted to codes
+            unknown = [ c for c, code in zip(categories, codes) if code not in indexes["categories"] ]
+            if unknown:
+                raise ValueError("Unknown categories {} (valid ones: {})".format(
+                    ", ".join(map(str, unknown)), ", ".join(self.categories_dict.keys())
+                ))
+            with_categories = [ indexes["categories"][code] for code in codes ]
+            selected = numpy.intersect1d(selected, numpy.concatenate(with_categories) if with_categories else [])
+
+        if path_prefix is not None:
+            start, end = numpy.searchsorted(indexes["sorted_paths"], [ path_prefix, path_prefix + chr(0x10FFFF) ])
+            selected = numpy.intersect1d(selected, indexes["paths_order"][start:end])
+
+        return self.view(selected, codes if only_categories else None)
+
+    def sample(self, images_num, seed=0):
+
+        # Returns a view of `images_num` random images (the same ones for the same `seed`), in the dataset order
+
+        generator = numpy.random.default_rng(seed)
+        chosen = generator.choice(len(self.images_paths), size=min(images_num, len(self.images_paths)), replace=False)
+
+        return self.view(numpy.sort(chosen))
+
+    def view(self, indices, categories=None):
+
+        # Returns a `Dataset` with only the images `indices` (and only the annotations of the `categories`
+        # codes, if given). Only the arrays of the selected images are copied, so a view is cheap to make
+        # and every method (`get`, `to_coco`, `register`, `query`...) works on it as on a whole dataset.
+
+        indices = numpy.asarray(indices, dtype=numpy.int64)
+        counts = numpy.diff(self.offsets)[indices]
+
+        # Indices of the annotations of the selected images (image after image):
+        first_annotations = numpy.repeat(self.offsets[indices] - numpy.concatenate(([0], numpy.cumsum(counts)[:-1])), counts)
+        annotations = first_annotations + numpy.arange(counts.sum())
+        if categories is not None:
+            keep = numpy.isin(self.categories[annotations], categories)
+            counts = numpy.bincount(numpy.repeat(numpy.arange(len(indices)), counts)[keep], minlength=len(indices))
+            annotations = annotations[keep]
+
+        view = copy.copy(self) # The settings are shared, the arrays are replaced
+        view.images_paths = self.images_paths[indices]
+        view.widths, view.heights = self.widths[indices], self.heights[indices]
+        view.channels = None if self.channels is None else self.channels[indices]
+        view.boxes, view.categories = self.boxes[annotations], self.categories[annotations]
+        view.offsets = numpy.zeros(len(indices) + 1, dtype=numpy.int64)
+        numpy.cumsum(counts, out=view.offsets[1:])
+        view.use_cache = False # The caches next to the CSV belong to the whole dataset
+        view.indexes = None
+        view.invalidate()
+
+        return view
+
+    def select(self, categories=None, path_prefix=None, sample=None, seed=0):
+
+        # Combines `query` and `sample` (every argument is optional), returns the dataset itself if nothing is selected
+
+        dataset = self
+        if categories is not None or path_prefix is not None:
+            dataset = dataset.query(categories=categories, path_prefix=path_prefix)
+        if sample is not None:
+            dataset = dataset.sample(sample, seed)
+
+        return dataset
+
+    def register(self, name):
+
+        # Registers the dataset in Detectron2's `DatasetCatalog` as `name` (the dicts are built when Detectron2
+        # asks for them) and returns its `MetadataCatalog` entry
+
+        from detectron2.data import DatasetCatalog, MetadataCatalog
+
+        DatasetCatalog.register(name, self.get)
+        metadata = MetadataCatalog.get(name)
+        metadata.image_root = self.base_dir
+        metadata.thing_classes = list(self.categories_dict.keys())
+
+        return metadata
+
+    def read_image_sizes(self, workers=8):
+
+        # Replaces the single `width`/`height` of `dataset_info.json` by the real size (and number of
+        # channels) of every image. Only the image headers are read, by `workers` threads, and the sizes
+        # are kept in an index next to the annotations CSV, so unchanged images are never opened again.
+
+        index_file = self.size_index_file if self.use_cache else None
+        self.widths, self.heights, self.channels = probe_images(
+            self.get_images_paths(), workers=workers, index_path=index_file, rebuild=self.rebuild_cache
+        )
+        self.rebuild_cache = False # The index was just rebuilt
+
+        self.invalidate() # The dicts and the COCO dataset are built again with the new sizes
+
+    def invalidate(self):
+
+        # Forgets the Detectron2 dicts and the COCO dataset built from the arrays (they are rebuilt when needed).
+        # Must be called whenever the arrays change.
+
+        self.images = None
+        self.coco_dataset = None
+
+    def _coco_categories(self):
+
+        return [{
                 "supercategory" : c,
                 "id" : self.categories_dict[c],
                 "name" : c
                 } for c in self.categories_dict.keys()]
 
+    def _coco_boxes(self, start, end):
+
+        # Returns the (x, y, w, h) boxes and the areas of the annotations `start:end`
+        # COCO uses (x, y, w, h) format, we use (x, y, x, y) format
+
+        boxes = self.boxes[start:end].astype(numpy.int64)
+        boxes[:, 2:] -= boxes[:, :2]
+
+        return boxes, boxes[:, 2] * boxes[:, 3]
+
+    def to_coco(self):
+
+        # Returns the dataset in the COCO format. It is built only once (until `invalidate()`),
+        # so the returned dictionary is shared and must not be modified.
+
+        if self.coco_dataset is None:
+            self.coco_dataset = self._build_coco()
+
+        return self.coco_dataset
+
+    def _build_coco(self):
+
+        # Getting the "images" COCO section (the image ID is the image index):
+        images = [{
+                "file_name" : file_name,
+                "height" : height,
+                "width" : width,
+                "id" : i
+                } for i, (file_name, width, height) in enumerate(zip(
+                    self.get_images_paths(), self.widths.tolist(), self.heights.tolist()
+                ))]
+
+        # Getting the "annotations" COCO section:
+        images_ids = numpy.repeat(numpy.arange(len(self.images_paths)), numpy.diff(self.offsets))
+        boxes, areas = self._coco_boxes(0, len(self.boxes))
+
+        annotations = [{
+                "image_id" : image_id,
+                "id" : annotation_id,
+                "bbox" : bbox,
+                "area" : area,
+                "iscrowd" : 0,
+                "category_id" : category_id
+                } for annotation_id, (image_id, bbox, area, category_id) in enumerate(zip(
+                    images_ids.tolist(), boxes.tolist(), areas.tolist(), self.categories.tolist()
+                ))]
+
         # Creating a COCO format JSON:
         coco_dataset = {
             "images" : images,
             "annotations" : annotations,
-            "categories" : categories
+            "categories" : self._coco_categories()
         }
 
         return coco_dataset
 
-
-    def to_pascal(self, destiny_folder):
+    def write_coco(self, file_path, image_ids=None, first_annotation_id=0, chunk_size=1 << 16):
+
+        # Writes the same JSON as `json.dump(self.to_coco(), f)`, `chunk_size` images/annotations at a time,
+        # without building the COCO dataset in memory.
+        # `image_ids` (optional) are the IDs of the images, instead of their indices
+        # (e.g. the "image_id" of the Detectron2 dicts, like Detectron2's `convert_to_coco_json`).
+        # `first_annotation_id` is the ID of the first annotation (pycocotools expects IDs from 1).
+
+        dumps = json.dumps
+        images_num = len(self.images_paths)
+        image_ids = [ dumps(image_id) for image_id in (range(images_num) if image_ids is None else image_ids) ]
+        images_paths = self.get_images_paths()
+        widths, heights = self.widths.tolist(), self.heights.tolist()
+        image_of_annotation = numpy.repeat(numpy.arange(images_num), numpy.diff(self.offsets))
+
+        # Writing to a temporary file first, so an interrupted write never leaves a broken file:
+        temporary_path = "{}.{}.tmp".format(file_path, os.getpid())
+        with open(temporary_path, "w") as f:
+
+            f.write('{"images": [')
+            for start in range(0, images_num, chunk_size):
+                f.write((", " if start else "") + ", ".join(
+                    '{{"file_name": {}, "height": {}, "width": {}, "id": {}}}'.format(
+                        dumps(images_paths[i]), heights[i], widths[i], image_ids[i]
+                    ) for i in range(start, min(start + chunk_size, images_num))
+                ))
+
+            f.write('], "annotations": [')
+            for start in range(0, len(self.boxes), chunk_size):
+                end = min(start + chunk_size, len(self.boxes))
+                boxes, areas = self._coco_boxes(start, end)
+                f.write((", " if start else "") + ", ".join(
+                    '{{"image_id": {}, "id": {}, "bbox": [{}, {}, {}, {}], "area": {}, "iscrowd": 0, "category_id": {}}}'.format(
+                        image_ids[image_index], annotation_id, *bbox, area, category_id
+                    ) for annotation_id, image_index, bbox, area, category_id in zip(
+                        range(first_annotation_id + start, first_annotation_id + end),
+                        image_of_annotation[start:end].tolist(), boxes.tolist(), areas.tolist(),
+                        self.categories[start:end].tolist()
+                    )
+                ))
+
+            f.write('], "categories": {}}}'.format(dumps(self._coco_categories())))
+
+        os.replace(temporary_path, file_path)
+
+
+    def to_pascal(self, destiny_folder, workers=None):
         
         # Converts annotation from COCO to PASCAL VOC DETECTION
+        # `workers` is the number of processes writing the XML files (default: number of CPUs)
+
+        from coco2pascal import create_annotations, create_imageset
 
         coco_dataset = self.to_coco()
         
@@ -179,6 +525,7 @@ class Dataset:
         annotations_folder = os.path.join(destiny_folder, "Annotations")
         imageset_folder = os.path.join(destiny_folder, "ImageSets", "Main")
 
-        # Converting to PASCAL VOC:
-        create_annotations(coco_dataset, dst=annotations_folder)
+        # Converting to PASCAL VOC (only the XML files that changed since the last export are written):
+        manifest_path = os.path.join(destiny_folder, "manifest.json")
+        create_annotations(coco_dataset, dst=annotations_folder, workers=workers, manifest_path=manifest_path)
         create_imageset(annotations_folder, self.dataset_type, imageset_folder)
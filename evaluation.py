@@ -0,0 +1,296 @@
+"""
+In-process evaluation straight from the Dataset arrays.
+
+`ArrayEvaluator` computes the same numbers as Detectron2's `PascalVOCDetectionEvaluator`
+(VOC 2012 AP at IoU 0.50:0.95) and `COCOEvaluator` (COCO AP@[.5:.95], 101 recall points,
+100 detections per image) without writing or parsing any annotation file.
+"""
+
+import numpy
+
+IOU_THRESHOLDS = numpy.linspace(0.5, 0.95, 10) # COCO IoU thresholds (0.50, 0.55, ..., 0.95)
+VOC_IOU_THRESHOLDS = numpy.arange(50, 100, 5) / 100.0 # The same thresholds, computed the way Detectron2 does
+RECALL_THRESHOLDS = numpy.linspace(0.0, 1.0, 101) # COCO precision is sampled at these recalls
+COCO_AREA_RANGES = {
+    "all" : (0, 1e10),
+    "small" : (0, 32 ** 2),
+    "medium" : (32 ** 2, 96 ** 2),
+    "large" : (96 ** 2, 1e10)
+}
+COCO_MAX_DETECTIONS = 100
+
+def iou_matrix(boxes_a, boxes_b, offset=0.0):
+
+    # Returns the (len(boxes_a), len(boxes_b)) IoU matrix of two XYXY box arrays.
+    # `offset` is 1.0 for the PASCAL VOC convention (inclusive pixel coordinates).
+
+    boxes_a = numpy.asarray(boxes_a, dtype=numpy.float64).reshape(-1, 4)
+    boxes_b = numpy.asarray(boxes_b, dtype=numpy.float64).reshape(-1, 4)
+
+    widths = numpy.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2]) - numpy.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0]) + offset
+    heights = numpy.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3]) - numpy.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1]) + offset
+    intersections = numpy.maximum(widths, 0.0) * numpy.maximum(heights, 0.0)
+
+    areas_a = (boxes_a[:, 2] - boxes_a[:, 0] + offset) * (boxes_a[:, 3] - boxes_a[:, 1] + offset)
+    areas_b = (boxes_b[:, 2] - boxes_b[:, 0] + offset) * (boxes_b[:, 3] - boxes_b[:, 1] + offset)
+    unions = areas_a[:, None] + areas_b[None, :] - intersections
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        return numpy.where(unions > 0, intersections / unions, 0.0)
+
+def voc_ap(recall, precision):
+
+    # Area under the precision/recall curve (VOC 2010+ metric, same as Detectron2's `voc_ap`)
+
+    mrec = numpy.concatenate(([0.0], recall, [1.0]))
+    mpre = numpy.concatenate(([0.0], precision, [0.0]))
+    mpre = numpy.flip(numpy.maximum.accumulate(numpy.flip(mpre)))
+    i = numpy.where(mrec[1:] != mrec[:-1])[0]
+
+    return numpy.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])
+
+class ArrayEvaluator:
+
+    def __init__(self, dataset):
+
+        # Ground truth, straight from the dataset arrays:
+        self.gt_boxes = dataset.boxes
+        self.gt_categories = dataset.categories
+        self.gt_offsets = dataset.offsets
+        self.class_names = list(dataset.categories_dict.keys())
+        self.num_classes = len(self.class_names)
+
+        # Maps the absolute image paths (the "file_name" of the image dicts) to the image indices:
+        self.images_indices = { path : i for i, path in enumerate(dataset.get_images_paths()) }
+
+        self.reset()
+
+    def reset(self):
+
+        # Predictions are kept as a list of (image index, boxes, scores, classes) arrays
+        self._predictions = []
+
+    def add(self, image_index, boxes, scores, classes):
+
+        # Adds the predictions of one image (XYXY_ABS boxes)
+
+        self._predictions.append((
+            image_index,
+            numpy.asarray(boxes, dtype=numpy.float32).reshape(-1, 4),
+            numpy.asarray(scores, dtype=numpy.float32).reshape(-1),
+            numpy.asarray(classes, dtype=numpy.int32).reshape(-1)
+        ))
+
+    def process(self, inputs, outputs):
+
+        # Same interface as the Detectron2 evaluators
+
+        for image, output in zip(inputs, outputs):
+            instances = output["instances"].to("cpu")
+            self.add(
+                self.images_indices[image["file_name"]],
+                instances.pred_boxes.tensor.numpy(),
+                instances.scores.numpy(),
+                instances.pred_classes.numpy()
+            )
+
+    def _grouped_predictions(self):
+
+        # Returns {(image index, class) : (boxes, scores)}, with the scores in decreasing order
+
+        grouped = {}
+        for image_index, boxes, scores, classes in self._predictions:
+            for c in numpy.unique(classes).tolist():
+                mask = classes == c
+                order = numpy.argsort(-scores[mask], kind="stable")
+                grouped[(image_index, c)] = (boxes[mask][order], scores[mask][order])
+
+        return grouped
+
+    def _ground_truth(self, image_index, c):
+
+        start, end = self.gt_offsets[image_index], self.gt_offsets[image_index + 1]
+        boxes = self.gt_boxes[start:end]
+
+        return boxes[self.gt_categories[start:end] == c]
+
+    def evaluate_pascal(self, grouped=None):
+
+        # Returns the results in the same format as `PascalVOCDetectionEvaluator`
+
+        grouped = self._grouped_predictions() if grouped is None else grouped
+        aps = numpy.zeros((len(VOC_IOU_THRESHOLDS), self.num_classes))
+
+        for c in range(self.num_classes):
+
+            npos = int(numpy.sum(self.gt_categories == c))
+            scores_list, tps_list = [], []
+
+            for (image_index, category), (boxes, scores) in grouped.items():
+                if category != c:
+                    continue
+
+                # Detectron2 writes the predictions as text, in 1-based VOC coordinates (xmin + 1, ymin + 1),
+                # with 3 decimals for the scores and 1 decimal for the boxes:
+                boxes = boxes.astype(numpy.float64)
+                boxes[:, :2] += 1
+                boxes = numpy.round(boxes, 1)
+                scores = numpy.round(scores.astype(numpy.float64), 3)
+
+                tps = numpy.zeros((len(VOC_IOU_THRESHOLDS), len(scores)), dtype=bool)
+                gt_boxes = self._ground_truth(image_index, c)
+                if len(gt_boxes):
+
+                    # Every detection is compared with its best ground truth box only,
+                    # the first (highest score) detection above the threshold gets it:
+                    ious = iou_matrix(boxes, gt_boxes, offset=1.0)
+                    best_gt, best_iou = ious.argmax(axis=1), ious.max(axis=1)
+                    for t, threshold in enumerate(VOC_IOU_THRESHOLDS):
+                        above = numpy.nonzero(best_iou > threshold)[0]
+                        _, first = numpy.unique(best_gt[above], return_index=True)
+                        tps[t, above[first]] = True
+
+                scores_list.append(scores)
+                tps_list.append(tps)
+
+            if not scores_list:
+                continue
+
+            # Accumulating every image in decreasing score order:
+            scores = numpy.concatenate(scores_list)
+            tps = numpy.concatenate(tps_list, axis=1)
+            order = numpy.argsort(-scores, kind="stable")
+            tp = numpy.cumsum(tps[:, order], axis=1)
+            fp = numpy.cumsum(~tps[:, order], axis=1)
+
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                recall = tp / float(npos)
+                precision = tp / numpy.maximum(tp + fp, numpy.finfo(numpy.float64).eps)
+            for t in range(len(VOC_IOU_THRESHOLDS)):
+                aps[t, c] = voc_ap(recall[t], precision[t])
+
+        aps = aps * 100
+        return { "bbox" : { "AP" : numpy.mean(aps), "AP50" : numpy.mean(aps[0]), "AP75" : numpy.mean(aps[5]) } }
+
+    def _coco_match(self, boxes, scores, gt_boxes, area_range):
+
+        # Matches the detections of one image and category (COCO rules).
+        # Returns the (thresholds, detections) matched and ignored flags and the number of valid ground truth boxes.
+
+        gt_areas = numpy.prod(gt_boxes[:, 2:] - gt_boxes[:, :2], axis=1).astype(numpy.float64)
+        gt_ignore = (gt_areas < area_range[0]) | (gt_areas > area_range[1])
+
+        # Not ignored ground truth boxes come first:
+        gt_order = numpy.argsort(gt_ignore, kind="stable")
+        gt_boxes, gt_ignore = gt_boxes[gt_order], gt_ignore[gt_order]
+
+        ious = iou_matrix(boxes, gt_boxes)
+        matched = numpy.zeros((len(IOU_THRESHOLDS), len(scores)), dtype=bool)
+        ignored = numpy.zeros((len(IOU_THRESHOLDS), len(scores)), dtype=bool)
+        gt_matched = numpy.zeros((len(IOU_THRESHOLDS), len(gt_boxes)), dtype=bool)
+
+        for t, threshold in enumerate(IOU_THRESHOLDS):
+            for d in range(len(scores)):
+
+                # Best ground truth box still available (ignored ones only if nothing else matches):
+                best, best_iou = -1, min(threshold, 1 - 1e-10)
+                for g in range(len(gt_boxes)):
+                    if gt_matched[t, g]:
+                        continue
+                    if best > -1 and not gt_ignore[best] and gt_ignore[g]:
+                        break
+                    if ious[d, g] < best_iou:
+                        continue
+                    best, best_iou = g, ious[d, g]
+
+                if best > -1:
+                    gt_matched[t, best] = True
+                    matched[t, d] = True
+                    ignored[t, d] = gt_ignore[best]
+
+        # Unmatched detections outside the area range are ignored too:
+        areas = numpy.prod(boxes[:, 2:] - boxes[:, :2], axis=1)
+        outside = (areas < area_range[0]) | (areas > area_range[1])
+        ignored |= ~matched & outside[None, :]
+
+        return matched, ignored, int(numpy.sum(~gt_ignore))
+
+    def evaluate_coco(self, grouped=None):
+
+        # Returns the results in the same format as `COCOEvaluator` (bbox only)
+
+        grouped = self._grouped_predictions() if grouped is None else grouped
+        num_images = len(self.gt_offsets) - 1
+        gt_images = numpy.repeat(numpy.arange(num_images), numpy.diff(self.gt_offsets))
+
+        # precision[area, class, threshold, recall]
+        precision = -numpy.ones((len(COCO_AREA_RANGES), self.num_classes, len(IOU_THRESHOLDS), len(RECALL_THRESHOLDS)))
+
+        for c in range(self.num_classes):
+
+            # Every image that has either a detection or a ground truth box of this class:
+            images_with_gt = numpy.unique(gt_images[self.gt_categories == c]).tolist()
+            images = sorted(set(images_with_gt) | set(i for (i, category) in grouped if category == c))
+            empty = (numpy.zeros((0, 4), dtype=numpy.float32), numpy.zeros(0, dtype=numpy.float32))
+
+            for a, area_range in enumerate(COCO_AREA_RANGES.values()):
+                scores_list, matched_list, ignored_list, npig = [], [], [], 0
+
+                for image_index in images:
+                    boxes, scores = grouped.get((image_index, c), empty)
+                    boxes, scores = boxes[:COCO_MAX_DETECTIONS], scores[:COCO_MAX_DETECTIONS]
+                    matched, ignored, valid_gt = self._coco_match(
+                        boxes.astype(numpy.float64), scores,
+                        self._ground_truth(image_index, c).astype(numpy.float64), area_range
+                    )
+                    scores_list.append(scores)
+                    matched_list.append(matched)
+                    ignored_list.append(ignored)
+                    npig += valid_gt
+
+                if npig == 0:
+                    continue # No ground truth: precision stays -1 (ignored in the mean)
+
+                scores = numpy.concatenate(scores_list) if scores_list else numpy.zeros(0)
+                order = numpy.argsort(-scores, kind="mergesort")
+                matched = numpy.concatenate(matched_list, axis=1)[:, order] if scores_list else numpy.zeros((len(IOU_THRESHOLDS), 0), dtype=bool)
+                ignored = numpy.concatenate(ignored_list, axis=1)[:, order] if scores_list else numpy.zeros((len(IOU_THRESHOLDS), 0), dtype=bool)
+
+                tps = numpy.cumsum(matched & ~ignored, axis=1).astype(numpy.float64)
+                fps = numpy.cumsum(~matched & ~ignored, axis=1).astype(numpy.float64)
+
+                for t in range(len(IOU_THRESHOLDS)):
+                    recall = tps[t] / npig
+                    pr = tps[t] / (fps[t] + tps[t] + numpy.spacing(1))
+
+                    # Interpolated (monotonically decreasing) precision sampled at the recall thresholds:
+                    pr = numpy.flip(numpy.maximum.accumulate(numpy.flip(pr)))
+                    indices = numpy.searchsorted(recall, RECALL_THRESHOLDS, side="left")
+                    sampled = numpy.zeros(len(RECALL_THRESHOLDS))
+                    valid = indices < len(pr)
+                    sampled[valid] = pr[indices[valid]]
+                    precision[a, c, t] = sampled
+
+        def mean_precision(values):
+            values = values[values > -1]
+            return float(numpy.mean(values)) * 100 if values.size else float("nan")
+
+        results = {
+            "AP" : mean_precision(precision[0]),
+            "AP50" : mean_precision(precision[0, :, 0]),
+            "AP75" : mean_precision(precision[0, :, 5]),
+            "APs" : mean_precision(precision[1]),
+            "APm" : mean_precision(precision[2]),
+            "APl" : mean_precision(precision[3])
+        }
+        for c, name in enumerate(self.class_names):
+            results["AP-" + name] = mean_precision(precision[0, c])
+
+        return { "bbox" : results }
+
+    def evaluate(self):
+
+        # Returns both the COCO and the PASCAL VOC results
+
+        grouped = self._grouped_predictions()
+        return { "coco" : self.evaluate_coco(grouped), "pascal" : self.evaluate_pascal(grouped) }
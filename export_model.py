@@ -0,0 +1,187 @@
+# This script exports the model of `test_info.json` to TorchScript (traced) for CPU inference, optionally with int8
+# dynamic quantization of the box head (its `torch.nn.Linear` layers). Then it predicts the test dataset with both
+# the eager and the exported model and reports the accuracy and latency deltas.
+# Usage: python3 export_model.py dataset_info.json test_info.json [--output model.ts] [--quantize] [--max-images N] [--no-compare] [--sample N]
+# The exported model is used by `test.py` with "BACKEND" : "torchscript" and "EXPORTED_MODEL_PATH" in `test_info.json`.
+
+import json, os, sys
+import cv2, numpy, torch
+
+from detectron2.export.torchscript_patch import patch_builtin_len
+
+# Our modules:
+from arguments import get_option, get_selection
+from inference import load_dataset, setup_cfg, predict
+from evaluation import ArrayEvaluator
+from predictor import BatchPredictor, ExportedPredictor, set_threads
+from predictions import instances_to_arrays
+from profiling import StageProfiler
+
+class TraceableDetector(torch.nn.Module):
+
+    # Wraps a Detectron2 model so it takes one preprocessed image tensor and returns tensors only:
+    # (boxes, scores, classes) in the coordinates of the preprocessed image (see `ExportedPredictor`)
+
+    def __init__(self, model):
+
+        super().__init__()
+        self.model = model
+
+    def forward(self, image):
+
+        instances = self.model.inference([{ "image" : image }], do_postprocess=False)[0]
+        return instances.pred_boxes.tensor, instances.scores, instances.pred_classes
+
+def check_traced(traced, detector, image, atol=1e-3):
+
+    # Compares the traced model with the eager one on `image`, raises an error if their outputs differ
+
+    with torch.no_grad():
+        expected = detector(image)
+        outputs = traced(image)
+
+    for name, value, expected_value in zip(("boxes", "scores", "classes"), outputs, expected):
+        if value.shape != expected_value.shape or not torch.allclose(value.float(), expected_value.float(), atol=atol):
+            raise RuntimeError(
+                "The traced model differs from the eager one on a {}x{} image ({}: {} vs {}), it was not saved".format(
+                    image.shape[2], image.shape[1], name, tuple(value.shape), tuple(expected_value.shape)
+                )
+            )
+
+def export(model, sample_image, check_image, output_path, quantize=False):
+
+    # Traces `model` with `sample_image` (a preprocessed image tensor) and saves it to `output_path`.
+    # With `quantize`, the linear layers (the box head) run with int8 weights (`model` itself is not changed).
+    # `check_image` (an image of another size) must give the same outputs with the traced and the eager model.
+
+    if quantize:
+        model = torch.quantization.quantize_dynamic(model, { torch.nn.Linear }, dtype=torch.qint8)
+
+    # `patch_builtin_len` keeps the `len()` of the tensors (e.g. the number of proposals of every image)
+    # dynamic, instead of freezing the values of `sample_image` into the graph:
+    detector = TraceableDetector(model)
+    with torch.no_grad(), patch_builtin_len():
+        traced = torch.jit.trace(detector, (sample_image,))
+
+    check_traced(traced, detector, check_image)
+    torch.jit.save(traced, output_path)
+
+def check_image_for(images, predictor, sample_image):
+
+    # Returns a preprocessed image whose size differs from `sample_image`: the first such image of the
+    # dataset, or a crop of the first image if every image has the same size
+
+    for image in images[1:]:
+        if (image["height"], image["width"]) != (images[0]["height"], images[0]["width"]):
+            check_image = predictor.preprocess(cv2.imread(image["file_name"]))["image"]
+            if check_image.shape != sample_image.shape:
+                return check_image
+
+    first = cv2.imread(images[0]["file_name"])
+    height, width = first.shape[:2]
+    return predictor.preprocess(numpy.ascontiguousarray(first[:height * 3 // 4, :width * 2 // 3]))["image"]
+
+def evaluate_backend(dataset, cfg, test_info, images, predictor):
+
+    # Predicts `images` with `predictor`, returns its metrics, latency percentiles and throughput
+
+    profiler = StageProfiler()
+    evaluator = ArrayEvaluator(dataset)
+    score_threshold = test_info["SCORE_THRESH_TEST"]
+
+    def on_batch(batch_images, batch_outputs):
+        for image, outputs in zip(batch_images, batch_outputs):
+            boxes, scores, classes = instances_to_arrays(outputs["instances"])
+            keep = scores > score_threshold
+            evaluator.add(evaluator.images_indices[image["file_name"]], boxes[keep], scores[keep], classes[keep])
+
+    predict(cfg, test_info, images, on_batch, profiler, predictor=predictor)
+    results = evaluator.evaluate()
+
+    return {
+        "coco" : results["coco"]["bbox"],
+        "pascal" : results["pascal"]["bbox"],
+        "latency" : profiler.latency_percentiles(),
+        "images_per_second" : len(images) / profiler.stages["inference"]["wall"]
+    }
+
+def report(eager, exported):
+
+    # Prints the metrics and the latency of both models and returns the deltas (exported - eager)
+
+    deltas = {
+        "coco_AP" : exported["coco"]["AP"] - eager["coco"]["AP"],
+        "coco_AP50" : exported["coco"]["AP50"] - eager["coco"]["AP50"],
+        "pascal_AP" : exported["pascal"]["AP"] - eager["pascal"]["AP"],
+        "pascal_AP50" : exported["pascal"]["AP50"] - eager["pascal"]["AP50"],
+        "p50_speedup" : eager["latency"]["p50_ms"] / exported["latency"]["p50_ms"],
+        "p95_speedup" : eager["latency"]["p95_ms"] / exported["latency"]["p95_ms"],
+        "throughput_speedup" : exported["images_per_second"] / eager["images_per_second"]
+    }
+
+    print("{:>10} {:>8} {:>8} {:>8} {:>8} {:>9} {:>9} {:>10}".format("model", "COCO AP", "AP50", "VOC AP", "AP50", "p50 ms", "p95 ms", "images/s"))
+    for name, results in (("eager", eager), ("exported", exported)):
+        print("{:>10} {:8.2f} {:8.2f} {:8.2f} {:8.2f} {:9.1f} {:9.1f} {:10.2f}".format(
+            name, results["coco"]["AP"], results["coco"]["AP50"], results["pascal"]["AP"], results["pascal"]["AP50"],
+            results["latency"]["p50_ms"], results["latency"]["p95_ms"], results["images_per_second"]
+        ))
+    print("AP delta: COCO {:+.2f}, VOC {:+.2f} | speedup: p50 {:.2f}x, throughput {:.2f}x".format(
+        deltas["coco_AP"], deltas["pascal_AP"], deltas["p50_speedup"], deltas["throughput_speedup"]
+    ))
+
+    return deltas
+
+def main(args):
+
+    # Getting the arguments from the command-line:
+    dataset_info_path = args[1]
+    test_info_path = args[2]
+    quantize = "--quantize" in args # int8 dynamic quantization of the box head
+    max_images = get_option(args, "--max-images") # Compares on the first N images only
+    compare = "--no-compare" not in args
+
+    with open(test_info_path, "r") as f:
+        test_info = json.load(f)
+    set_threads(test_info.get("INTRA_OP_THREADS", 0), test_info.get("INTER_OP_THREADS", 0))
+
+    default_name = "model_quantized.ts" if quantize else "model.ts"
+    output_path = get_option(args, "--output", os.path.join(os.path.dirname(test_info["WEIGHTS_PATH"]), default_name))
+
+    dataset, _ = load_dataset(dataset_info_path, True, False, get_selection(args))
+    if max_images is not None:
+        # A view, so the evaluators only get the ground truth of the predicted images:
+        dataset = dataset.view(numpy.arange(min(int(max_images), len(dataset.images_paths))))
+    images = dataset.get()
+
+    # The exported model runs on the CPU, the eager one too (for a fair comparison):
+    cfg = setup_cfg(test_info)
+    cfg.MODEL.DEVICE = "cpu"
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = test_info["SCORE_THRESH_TEST"] # Part of the traced model
+
+    # Tracing with the first image of the dataset:
+    predictor = BatchPredictor(cfg)
+    sample_image = predictor.preprocess(cv2.imread(images[0]["file_name"]))["image"]
+    export(predictor.model, sample_image, check_image_for(images, predictor, sample_image), output_path, quantize)
+    print("Model exported to {}".format(output_path))
+
+    if not compare:
+        return
+
+    # Predicting with both models:
+    eager = evaluate_backend(dataset, cfg, test_info, images, predictor)
+    exported = evaluate_backend(dataset, cfg, test_info, images, ExportedPredictor(cfg, output_path))
+    deltas = report(eager, exported)
+
+    with open(os.path.splitext(output_path)[0] + "_report.json", "w") as f:
+        json.dump({
+            "quantized" : quantize,
+            "images" : len(images),
+            "intra_op_threads" : torch.get_num_threads(),
+            "inter_op_threads" : torch.get_num_interop_threads(),
+            "eager" : eager,
+            "exported" : exported,
+            "deltas" : deltas
+        }, f, indent=2)
+
+if __name__ == "__main__":
+    main(sys.argv)
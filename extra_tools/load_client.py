@@ -0,0 +1,80 @@
+# This script sends images to `serve.py` from several threads at once, to test its micro-batching under load.
+# It prints the latency seen by the client and the metrics of the server.
+# Usage: python3 extra_tools/load_client.py images_folder_or_files [--url http://127.0.0.1:8080] [--concurrency 8] [--requests 200]
+
+import argparse, json, os, time # Files, time and command-line arguments manipulation
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import numpy
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+def get_images(paths):
+
+    # Returns the content of every image of `paths` (files or folders)
+
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(
+                os.path.join(path, name) for name in os.listdir(path) if name.lower().endswith(IMAGE_EXTENSIONS)
+            ))
+        else:
+            files.append(path)
+
+    images = []
+    for file_path in files:
+        with open(file_path, "rb") as f:
+            images.append(f.read())
+
+    return images
+
+def post_image(url, image):
+
+    # Returns the latency (seconds) of one prediction request and whether it succeeded
+
+    request = urllib.request.Request(url + "/predict", data=image, headers={ "Content-Type" : "application/octet-stream" })
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request) as response:
+            response.read()
+            ok = response.status == 200
+    except OSError:
+        ok = False
+
+    return time.perf_counter() - start, ok
+
+def get_arguments():
+
+    parser = argparse.ArgumentParser(description="Load testing client for `serve.py`.")
+    parser.add_argument("images", nargs="+", help="Image files or folders with images")
+    parser.add_argument("--url", default="http://127.0.0.1:8080", help="Address of the server")
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of requests in flight at once")
+    parser.add_argument("--requests", type=int, default=200, help="Total number of requests (the images are reused)")
+
+    return parser.parse_args()
+
+def main():
+
+    args = get_arguments()
+    images = get_images(args.images)
+    if not images:
+        raise FileNotFoundError("No image found")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda i: post_image(args.url, images[i % len(images)]), range(args.requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = 1000 * numpy.array([ latency for latency, _ in results ])
+    failed = sum(not ok for _, ok in results)
+    p50, p95, p99 = numpy.percentile(latencies, [50, 95, 99])
+    print("{} requests ({} failed) in {:.2f}s: {:.2f} requests/s".format(len(results), failed, elapsed, len(results) / elapsed))
+    print("Client latency: p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms".format(p50, p95, p99))
+
+    # Showing the server side of the story (batch sizes, queue wait...):
+    with urllib.request.urlopen(args.url + "/metrics") as response:
+        print(json.dumps(json.load(response), indent=2))
+
+if __name__ == "__main__":
+    main()
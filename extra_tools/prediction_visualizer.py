@@ -1,9 +1,15 @@
 # This script will allow you to visualize the annotations on "predictions.json" file
-# The input of this scripted is outputed by `test.py`
+# The input of this scripted is outputed by `test.py`, it may also be the "predictions_bin" directory
 
 import cv2, numpy # Our script is highly dependant of opencv
 
-import json, os, sys # Files, system and command-line arguments manipulation
+import argparse, json, os, sys # Files, system and command-line arguments manipulation
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# The binary predictions reader lives at the root of the repository:
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from predictions import PredictionStore
 
 def draw_bbox(image, x0, y0, x1, y1, label, color):
 
@@ -37,31 +43,61 @@ def draw_bbox(image, x0, y0, x1, y1, label, color):
 
     return out_image
 
-# Getting the arguments from the command-line:
-args = {
-    "predictions_json" : sys.argv[1],
-    "base_directory" : sys.argv[2] # The directory where the images are stored.
-}
+def load_predictions(predictions_path):
+
+    # Yields the image infos (same format as the "predictions.json" entries) one at a time.
+    # A "predictions_bin" directory is read lazily, image by image (memory-mapped).
+    # A JSON file has to be loaded at once.
+
+    if os.path.isdir(predictions_path):
+        store = PredictionStore(predictions_path)
+        for i in range(len(store)):
+            yield store.image_info(i)
+    else:
+        with open(predictions_path, "r") as json_file:
+            for image_info in json.load(json_file):
+                yield image_info
+
+def filter_image(image_info, min_score=None, classes=None, max_boxes=None):
+
+    # Keeps only the predictions with a score above `min_score` and a class in `classes`,
+    # and at most `max_boxes` of them (the ones with the highest scores).
+    # Scores are only available in "predictions_bin", they are ignored for "predictions.json".
+
+    predictions = image_info["predictions"]
+    if min_score is not None:
+        predictions = [ p for p in predictions if p.get("score", 1.0) > min_score ]
+    if classes is not None:
+        predictions = [ p for p in predictions if p["category_id"] in classes ]
+    if max_boxes is not None:
+        predictions = sorted(predictions, key=lambda p: -p.get("score", 1.0))[:max_boxes]
 
-# Loading the JSON file:
-with open(args["predictions_json"], "r") as json_file:
-    predictions = json.load(json_file)
+    annotations = image_info["annotations"]
+    if classes is not None:
+        annotations = [ a for a in annotations if a["category_id"] in classes ]
 
-# Visualization ouput directory
-vis_out_dir = "./vis_output"
-os.makedirs(vis_out_dir, exist_ok=True) # Creating the directory, if it doesn't exist
+    return dict(image_info, predictions=predictions, annotations=annotations)
 
-# Iterating through the images of JSON:
-for image_info in predictions:
+def output_path_of(image_abs_path, base_directory, vis_out_dir):
 
-    # Getting the image "absolute" path:
-    image_abs_path = os.path.join(args["base_directory"], image_info["image_name"])
+    # Keeps the folders of the image relative to `base_directory` (the images never overwrite each other)
 
-    # Setting the visualization output path:
-    image_out_path = os.path.join(vis_out_dir, image_info["image_name"])
+    relative_path = os.path.relpath(os.path.abspath(image_abs_path), os.path.abspath(base_directory))
+    if relative_path.startswith(os.pardir):
+        relative_path = os.path.basename(image_abs_path)
+
+    return os.path.join(vis_out_dir, relative_path)
+
+def render_image(task):
+
+    # Draws the predictions and the annotations of an image and saves it (runs in a worker process)
+
+    image_info, image_abs_path, image_out_path = task
 
     # Loading the image:
     image = cv2.imread(image_abs_path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        return None
 
     # Drawing the predicted annotations at the image:
     predicted_margin_color = (255, 0, 0)
@@ -86,6 +122,73 @@ for image_info in predictions:
         )
 
     # Saving the image at the directory:
+    os.makedirs(os.path.dirname(image_out_path), exist_ok=True)
     cv2.imwrite(image_out_path, image)
 
-
+    return image_out_path
+
+def get_arguments():
+
+    # Getting the arguments from the command-line:
+    parser = argparse.ArgumentParser(description="Draws the predictions and the annotations written by `test.py`.")
+    parser.add_argument("predictions_json", help="\"predictions.json\" file or \"predictions_bin\" directory")
+    parser.add_argument("base_directory", help="The directory where the images are stored.")
+    parser.add_argument("--output", default="./vis_output", help="Visualization output directory")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of rendering processes")
+    parser.add_argument("--in-flight", type=int, default=64, help="Maximum number of images being rendered at once")
+    parser.add_argument("--images", help="File with the names of the images to render (one per line)")
+    parser.add_argument("--min-score", type=float, help="Only draws the predictions above this score")
+    parser.add_argument("--classes", type=int, nargs="+", help="Only draws these category ids")
+    parser.add_argument("--max-boxes", type=int, help="Maximum number of predictions drawn per image")
+    parser.add_argument("--max-images", type=int, help="Maximum number of images rendered")
+    parser.add_argument("--resume", action="store_true", help="Skips the images already rendered")
+
+    return parser.parse_args()
+
+def get_tasks(args):
+
+    # Yields the (image_info, image_abs_path, image_out_path) of every image that has to be rendered
+
+    images_subset = None
+    if args.images is not None:
+        with open(args.images, "r") as f:
+            images_subset = set(line.strip() for line in f if line.strip())
+
+    classes = set(args.classes) if args.classes is not None else None
+    count = 0
+    for image_info in load_predictions(args.predictions_json):
+        if args.max_images is not None and count >= args.max_images:
+            break
+        if images_subset is not None and image_info["image_name"] not in images_subset:
+            continue
+
+        # Getting the image "absolute" path and the visualization output path:
+        image_abs_path = os.path.join(args.base_directory, image_info["image_name"])
+        image_out_path = output_path_of(image_abs_path, args.base_directory, args.output)
+        count += 1
+
+        if args.resume and os.path.isfile(image_out_path):
+            continue
+
+        yield filter_image(image_info, args.min_score, classes, args.max_boxes), image_abs_path, image_out_path
+
+def main():
+
+    args = get_arguments()
+    os.makedirs(args.output, exist_ok=True) # Creating the directory, if it doesn't exist
+
+    # Rendering from a pool of processes, with at most `in_flight` images waiting at once:
+    rendered = 0
+    with ProcessPoolExecutor(max_workers=max(args.workers or 1, 1)) as executor:
+        pending = deque()
+        for task in get_tasks(args):
+            pending.append(executor.submit(render_image, task))
+            if len(pending) >= args.in_flight:
+                rendered += pending.popleft().result() is not None
+        while pending:
+            rendered += pending.popleft().result() is not None
+
+    print("{} images rendered at {}".format(rendered, args.output))
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import cv2, os, sys
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
 # This script allow us to visualize the annotations of a generated dataset.
 
@@ -12,91 +13,83 @@ def get_arguments():
         "output_directory" : sys.argv[2]
     }
 
-def get_annotations(images_list_path, base_xml_path):
+def parse_voc_xml(xml_path):
+
+    # Parses every object of a PASCAL VOC XML file (incrementally, the tree is never fully built)
+    # Returns the image path, the categories names and the bounding boxes (x0, y0, x1, y1)
+    # Only the direct "name" and "bndbox" children of an object are read (not the ones of its parts),
+    # the objects without a name or a complete box are skipped with a warning.
+
+    from lxml import etree
+
+    folder, filename = "", ""
+    categories, boxes = [], []
+
+    for _, element in etree.iterparse(xml_path, events=("end",), tag=("folder", "filename", "object")):
+        parent = element.getparent()
+        if element.tag != "object":
+            if parent is not None and parent.getparent() is None: # Children of the root only
+                if element.tag == "folder":
+                    folder = element.text or ""
+                else:
+                    filename = element.text or ""
+            continue
+        if parent is None or parent.getparent() is not None:
+            continue # Not an object of the image
+
+        category = element.findtext("name")
+        bndbox = element.find("bndbox")
+        coordinates = [ bndbox.findtext(key) if bndbox is not None else None for key in ("xmin", "ymin", "xmax", "ymax") ]
+        if not category or any(not value for value in coordinates):
+            print("WARNING: skipping an incomplete object ({}) in {}".format(category, xml_path), file=sys.stderr)
+        else:
+            categories.append(category.strip())
+            boxes.append([ int(float(value)) for value in coordinates ])
+        element.clear() # Objects are not needed anymore once they are read
 
-    # Returns a list of dictionaries
-    # Each dictionary of the list is an annotated image
+    return os.path.join(folder, filename), categories, boxes
 
-    # Getting the list of files:
-    images_xml_paths = []
+def get_annotations(images_list_path, base_xml_path, workers=None):
 
-    # Getting the "train.txt" images XML:
-    with open(os.path.join(images_list_path, "train.txt"), "r") as images_list_file:
-        lines = images_list_file.read().strip().split("\n")
-        for line in lines:
-            if line != "":
-                images_xml_paths.append(line)
-
-    # Getting the "test.txt" images XML:
-    with open(os.path.join(images_list_path, "test.txt"), "r") as images_list_file:
-        lines = images_list_file.read().strip().split("\n")
-        for line in lines:
-            if line != "":
-                images_xml_paths.append(line)
-
-    images_dict = {} # We use a dict to merge the annotations by image
-    
-    from lxml import etree, objectify
-
-
-    # Converting the XML to CSV style:
-    annotation_lines = []
-    for xml_file_path in images_xml_paths:
-        with open(base_xml_path.format(xml_file_path), "r") as xml_file:
-            my_xml = etree.XML(xml_file.read())
-
-        folder_index = 0
-        filename_index = 1
-        annotation_info_index = -1
-
-        image_abs_path = os.path.join(my_xml[folder_index].text, my_xml[filename_index].text)
-
-        annotations = my_xml[annotation_info_index]
-        annotation = annotations
-        # for annotation in annotations:
-        category_index = 0
-        bbox_index = -1
-
-        category = annotation[category_index].text
-        bbox = annotation[bbox_index]
-        x0, y0, x1, y1 = bbox
-
-        csv_line = f"{image_abs_path},{x0.text},{y0.text},{x1.text},{y1.text},{category}"
-        annotation_lines.append(csv_line)
-                
-    # Inserting each annotation to the images_dict
-    for line in annotation_lines:
-
-        # Getting annotation info:
-        annotation_info = line.split(",")
-        image_rel_path = annotation_info[0] # Image relative path
-        x0, y0 = annotation_info[1], annotation_info[2]
-        x1, y1 = annotation_info[3], annotation_info[4]
-        category = annotation_info[5]
-
-        annotation_dict = {
-            "x0" : int(x0),
-            "y0" : int(y0),
-            "x1" : int(x1),
-            "y1" : int(y1),
-            "category" : category
-        }
-
-        # Inserting the annotation at the images_dict:
-        if image_rel_path in images_dict.keys():
-            images_dict[image_rel_path]["annotations"].append(annotation_dict)
-        else:
-            images_dict[image_rel_path] = {
-                "image_name" : image_rel_path,
-                "annotations" : [annotation_dict]
-            }
+    # Returns a dictionary of arrays with every annotation of the dataset:
+    # "images_paths" : list of image paths
+    # "offsets" : `offsets[i]:offsets[i + 1]` are the annotations of the i-th image
+    # "boxes" : (N, 4) int32 array of (x0, y0, x1, y1)
+    # "categories" : (N,) int32 array, indices into "categories_names"
+    # "categories_names" : list of the categories names
 
-    # Converting from images_dict to images_list:
-    images_list = []
-    for key in images_dict.keys():
-        images_list.append(images_dict[key])
+    # Getting the list of files ("train.txt" and "test.txt" images XML):
+    images_xml_paths = []
+    for list_name in ("train.txt", "test.txt"):
+        with open(os.path.join(images_list_path, list_name), "r") as images_list_file:
+            images_xml_paths += [ base_xml_path.format(line.strip()) for line in images_list_file if line.strip() ]
+
+    # Parsing the XML files from a pool of processes:
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        parsed = list(executor.map(parse_voc_xml, images_xml_paths, chunksize=256))
+
+    # Merging the objects by image (an image may be listed more than once):
+    images_index = {}
+    image_codes, boxes, categories = [], [], []
+    for image_path, image_categories, image_boxes in parsed:
+        code = images_index.setdefault(image_path, len(images_index))
+        image_codes += [ code ] * len(image_boxes)
+        boxes += image_boxes
+        categories += image_categories
+
+    categories_names, categories_codes = np.unique(np.array(categories, dtype=str), return_inverse=True)
+    image_codes = np.array(image_codes, dtype=np.int64)
+    order = np.argsort(image_codes, kind="stable")
+    offsets = np.zeros(len(images_index) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(image_codes, minlength=len(images_index)), out=offsets[1:])
 
-    return images_list
+    return {
+        "images_paths" : list(images_index.keys()),
+        "offsets" : offsets,
+        "boxes" : np.array(boxes, dtype=np.int32).reshape(-1, 4)[order],
+        "categories" : categories_codes.reshape(-1).astype(np.int32)[order],
+        "categories_names" : categories_names.tolist()
+    }
 
 def draw_bounding_box(image, x0, y0, x1, y1, color=(0, 0, 255), thickness=3):
 
@@ -111,29 +104,25 @@ def main():
     input_dir = args["dataset_root"]
     images_list_path = os.path.join(input_dir, "ImageSets", "Main")
     base_xml_path = os.path.join(input_dir, "Annotations", "{}.xml")
-    images = get_annotations(images_list_path, base_xml_path)
+    annotations = get_annotations(images_list_path, base_xml_path)
 
     # Creating the output directory (if it doesn't exist):
     output_dir = args["output_directory"]
     images_dir = os.path.join(output_dir)
     os.makedirs(os.path.join(images_dir, "images"), exist_ok=True)
 
-    for i in images:
+    offsets, boxes = annotations["offsets"], annotations["boxes"]
+    for i, image_path in enumerate(annotations["images_paths"]):
 
         # Reading the image
-        input_image_path = i["image_name"]
-        out_image = cv2.imread(input_image_path, cv2.IMREAD_UNCHANGED)
+        out_image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
 
         # Drawing every bounding box of the image in the output image
-        for annotation in i["annotations"]:
-
-            x0, y0 = annotation["x0"], annotation["y0"]
-            x1, y1 = annotation["x1"], annotation["y1"]
-
+        for x0, y0, x1, y1 in boxes[offsets[i]:offsets[i + 1]].tolist():
             out_image = draw_bounding_box(out_image, x0, y0, x1, y1)
 
         # Saving the output image
-        output_path = os.path.join(images_dir, os.path.split(i["image_name"])[-1])
+        output_path = os.path.join(images_dir, os.path.split(image_path)[-1])
         print(output_path)
         cv2.imwrite(output_path, out_image)
 
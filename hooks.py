@@ -0,0 +1,135 @@
+"""
+Training instrumentation: per-iteration stage timings, throughput, data loader
+starvation and peak memory, written as JSONL to the training output folder.
+"""
+
+import json, os, time
+import numpy, torch
+
+from detectron2.engine import HookBase
+
+from pipeline import StageTimer
+from profiling import peak_rss_mb
+
+STAGES = ("data", "forward", "backward", "optimizer")
+
+class ThroughputHook(HookBase):
+
+    # Writes one JSON line per iteration to `<OUTPUT_DIR>/throughput.jsonl` and prints a summary
+    # when the training ends. The trainer's own `run_step` (`SimpleTrainer`, `AMPTrainer`...) is left
+    # untouched: the stages are timed around it, with hooks on the model and on the optimizer
+    # (CUDA is synchronized at every boundary).
+    # "data" : from the step start to the forward pass (waiting for the data loader)
+    # "forward" : the model, the host-to-device copy of the images included
+    # "backward" : from the end of the forward pass to the optimizer step (losses, gradients, metrics)
+    # "optimizer" : the optimizer step (0 when it is skipped, e.g. by the AMP grad scaler)
+
+    def __init__(self, output_dir, starvation_ratio=0.1, flush_every=20):
+
+        # An iteration is "starved" when waiting for the data loader takes more than
+        # `starvation_ratio` of the iteration time
+
+        self.output_path = os.path.join(output_dir, "throughput.jsonl")
+        self.starvation_ratio = starvation_ratio
+        self.flush_every = flush_every
+
+    def before_train(self):
+
+        self.file = open(self.output_path, "w")
+        self.timer = StageTimer()
+        self.images_per_second = []
+        self.starved = 0
+        self._synchronize = torch.cuda.synchronize if torch.cuda.is_available() else (lambda: None)
+
+        # Boundaries of the current step (`time.perf_counter()` values):
+        self._marks, self._step_images = {}, 0
+
+        def mark(name):
+            self._synchronize()
+            self._marks.setdefault(name, time.perf_counter()) # The first call of the step counts
+
+        def before_forward(module, inputs):
+            if "forward" not in self._marks: # Not a later forward pass (e.g. an evaluation hook)
+                self._step_images = len(inputs[0]) if inputs else 0
+            mark("forward")
+
+        model, optimizer = self.trainer.model, self.trainer.optimizer
+        self._handles = [
+            model.register_forward_pre_hook(before_forward),
+            model.register_forward_hook(lambda module, inputs, outputs: mark("backward"))
+        ]
+        if hasattr(optimizer, "register_step_pre_hook"): # PyTorch >= 2.0, the step is part of "backward" otherwise
+            self._handles += [
+                optimizer.register_step_pre_hook(lambda *args: mark("optimizer")),
+                optimizer.register_step_post_hook(lambda *args: mark("end"))
+            ]
+
+    def before_step(self):
+
+        self._marks, self._step_images = {}, 0
+        self._synchronize()
+        self._marks["data"] = time.perf_counter()
+
+    def _step_timings(self):
+
+        # Converts the boundaries of the step into the duration of every stage (a missing boundary, e.g. a
+        # skipped optimizer step, makes its stage last 0). The other hooks' `after_step` come after "end".
+
+        self._synchronize()
+        end = time.perf_counter()
+        boundaries = [ (stage, self._marks[stage]) for stage in STAGES if stage in self._marks ]
+        boundaries.append(("end", self._marks.get("end", end)))
+
+        timings = dict.fromkeys(STAGES, 0.0)
+        for (stage, start), (_, stop) in zip(boundaries, boundaries[1:]):
+            timings[stage] = stop - start
+
+        return timings
+
+    def after_step(self):
+
+        timings, images = self._step_timings(), self._step_images
+        total = sum(timings.values())
+        for stage, seconds in timings.items():
+            self.timer.add(stage, seconds)
+
+        starved = timings["data"] > self.starvation_ratio * total
+        self.starved += starved
+        self.images_per_second.append(images / total)
+
+        record = { "iteration" : self.trainer.iter, "images" : images, "total" : total }
+        record.update(timings)
+        record.update({
+            "images_per_second" : images / total,
+            "starved" : bool(starved),
+            "peak_rss_mb" : peak_rss_mb()
+        })
+        if torch.cuda.is_available():
+            record["peak_cuda_mb"] = torch.cuda.max_memory_allocated() / (1 << 20)
+        self.file.write(json.dumps(record) + "\n")
+        if len(self.images_per_second) % self.flush_every == 0:
+            self.file.flush()
+
+    def after_train(self):
+
+        for handle in self._handles:
+            handle.remove()
+        self.file.close()
+        if not self.images_per_second:
+            return
+
+        # Printing the summary of the whole training:
+        summary = self.timer.summary()
+        total = sum(info["total"] for info in summary.values())
+        print("Training throughput ({} iterations):".format(len(self.images_per_second)))
+        for stage in STAGES:
+            info = summary.get(stage, { "total" : 0.0, "mean" : 0.0 })
+            print("{:>12}: {:8.4f}s mean, {:5.1f}% of the time".format(stage, info["mean"], 100 * info["total"] / total))
+        print("images/sec: {:.2f} mean, {:.2f} median".format(
+            numpy.mean(self.images_per_second), numpy.median(self.images_per_second)
+        ))
+        starved = self.starved / len(self.images_per_second)
+        print("Starved iterations: {:.1f}% (waiting for the data loader)".format(100 * starved))
+        print("Peak RSS: {:.0f} MiB (main process), {:.0f} MiB (finished children)".format(peak_rss_mb(), peak_rss_mb(children=True)))
+        if starved > 0.1:
+            print("The data loader is the bottleneck: try a larger NUM_WORKERS (or the IMAGE_CACHE)")
@@ -0,0 +1,207 @@
+"""
+Pre-decoded training images: every image of the dataset is decoded once
+(and optionally resized to the training input size) into a flat uint8
+file, read back with zero copies through a memory map while training.
+"""
+
+import copy, json, os
+import cv2, numpy, torch
+
+import detectron2.data.transforms as T
+from detectron2.data import DatasetMapper
+from detectron2.structures import BoxMode
+
+from pipeline import prefetch
+
+def target_scale(height, width, min_size, max_size):
+
+    # Returns the scale that makes the shortest edge `min_size` (the longest one at most `max_size`).
+    # Images are never upscaled: the augmentations still resize them while training.
+
+    scale = min_size / min(height, width)
+    if max(height, width) * scale > max_size:
+        scale = max_size / max(height, width)
+
+    return min(scale, 1.0)
+
+def build_image_cache(images, cache_dir, min_size=None, max_size=None, workers=8):
+
+    # Decodes every image of `images` (Detectron2-format dicts) into `cache_dir`:
+    # "images.bin" (every image, BGR uint8, one after the other) and "index.json".
+    # `min_size`/`max_size` (optional) resize the images to the training input size.
+
+    os.makedirs(cache_dir, exist_ok=True)
+    file_names = [ image["file_name"] for image in images ]
+    index_path = os.path.join(cache_dir, "index.json")
+    data_path = os.path.join(cache_dir, "images.bin")
+
+    # The old index goes first, so an interrupted build never leaves an index of another "images.bin":
+    if os.path.exists(index_path):
+        os.remove(index_path)
+
+    # The modification time and size of every image, to notice the images replaced later (see `is_valid`):
+    stats = [ file_stat(file_name) for file_name in file_names ]
+
+    def load(file_name):
+        image = cv2.imread(file_name, cv2.IMREAD_COLOR)
+        if image is None:
+            raise OSError("Could not read {}".format(file_name))
+        height, width = image.shape[:2]
+        scale = target_scale(height, width, min_size, max_size) if min_size else 1.0
+        if scale < 1.0:
+            image = cv2.resize(image, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+        # The real scale of every axis (after rounding the new size):
+        return image, (image.shape[1] / width, image.shape[0] / height)
+
+    offsets, shapes, scales = [], [], []
+    offset = 0
+    temporary_path = "{}.{}.tmp".format(data_path, os.getpid())
+    with open(temporary_path, "wb") as f:
+        for image, scale in prefetch(file_names, load, num_workers=workers, queue_depth=4 * workers):
+            f.write(numpy.ascontiguousarray(image).tobytes())
+            offsets.append(offset)
+            shapes.append(list(image.shape))
+            scales.append(list(scale))
+            offset += image.nbytes
+    os.replace(temporary_path, data_path)
+
+    # The index is written last, a cache without it is incomplete:
+    index = {
+        "file_names" : file_names,
+        "stats" : stats,
+        "offsets" : offsets,
+        "shapes" : shapes,
+        "scales" : scales,
+        "min_size" : min_size,
+        "max_size" : max_size
+    }
+    temporary_path = "{}.{}.tmp".format(index_path, os.getpid())
+    with open(temporary_path, "w") as f:
+        json.dump(index, f)
+    os.replace(temporary_path, index_path)
+
+    return ImageCache(cache_dir)
+
+def file_stat(file_name):
+
+    # Returns [modification time (ns), size] of a file, as in the size index of `image_probe`
+
+    stat = os.stat(file_name)
+    return [ stat.st_mtime_ns, stat.st_size ]
+
+class ImageCache:
+
+    def __init__(self, cache_dir):
+
+        with open(os.path.join(cache_dir, "index.json"), "r") as f:
+            index = json.load(f)
+
+        self.min_size, self.max_size = index["min_size"], index["max_size"]
+        self.positions = { file_name : i for i, file_name in enumerate(index["file_names"]) }
+        self.stats = index.get("stats") # Missing in the caches built before the stats were stored
+        self.offsets = index["offsets"]
+        self.shapes = [ tuple(shape) for shape in index["shapes"] ]
+        self.scales = [ tuple(scale) for scale in index["scales"] ]
+        self.cache_dir = cache_dir
+        self._data = None # Memory map, opened on the first read (once per data loader worker)
+
+    def __getstate__(self):
+
+        # The memory map is never pickled (that would copy every image), the workers open their own
+
+        state = dict(self.__dict__)
+        state["_data"] = None
+        return state
+
+    @property
+    def data(self):
+
+        if self._data is None:
+            self._data = numpy.memmap(os.path.join(self.cache_dir, "images.bin"), dtype=numpy.uint8, mode="r")
+        return self._data
+
+    def __contains__(self, file_name):
+        return file_name in self.positions
+
+    def is_valid(self, images, min_size=None, max_size=None):
+
+        # True if the cache has exactly the images of `images`, unchanged since it was built, at the same sizes
+
+        if self.stats is None or (self.min_size, self.max_size) != (min_size, max_size):
+            return False
+        if len(self.positions) != len(images) or not all(image["file_name"] in self for image in images):
+            return False
+        if not os.path.isfile(os.path.join(self.cache_dir, "images.bin")):
+            return False
+
+        try:
+            return all(file_stat(file_name) == self.stats[i] for file_name, i in self.positions.items())
+        except OSError:
+            return False
+
+    def get(self, file_name):
+
+        # Returns the cached image (read-only BGR view of the memory map) and its (x, y) scale
+
+        i = self.positions[file_name]
+        shape = self.shapes[i]
+        size = shape[0] * shape[1] * shape[2]
+        image = self.data[self.offsets[i]:self.offsets[i] + size].reshape(shape)
+
+        return image, self.scales[i]
+
+class CachedDatasetMapper(DatasetMapper):
+
+    # Same as Detectron2's `DatasetMapper` (boxes only), but the images come from an `ImageCache`
+    # instead of being decoded from the disk. The annotations are scaled to the cached image size.
+
+    def __init__(self, cfg, image_cache, is_train=True):
+
+        super().__init__(cfg, is_train=is_train)
+        self.image_cache = image_cache
+
+    def __call__(self, dataset_dict):
+
+        dataset_dict = copy.deepcopy(dataset_dict)  # it will be modified by code below
+
+        image, (scale_x, scale_y) = self.image_cache.get(dataset_dict["file_name"])
+        if self.image_format == "RGB":
+            image = image[:, :, ::-1]
+        dataset_dict["height"], dataset_dict["width"] = image.shape[:2]
+
+        # Scaling the annotations to the cached image:
+        for annotation in dataset_dict.get("annotations", []):
+            x0, y0, x1, y1 = BoxMode.convert(annotation["bbox"], annotation["bbox_mode"], BoxMode.XYXY_ABS)
+            annotation["bbox"] = [ x0 * scale_x, y0 * scale_y, x1 * scale_x, y1 * scale_y ]
+            annotation["bbox_mode"] = BoxMode.XYXY_ABS
+
+        aug_input = T.AugInput(image)
+        transforms = self.augmentations(aug_input)
+        image = aug_input.image
+
+        image_shape = image.shape[:2]  # h, w
+        dataset_dict["image"] = torch.as_tensor(numpy.ascontiguousarray(image.transpose(2, 0, 1)))
+
+        if not self.is_train:
+            dataset_dict.pop("annotations", None)
+            return dataset_dict
+
+        if "annotations" in dataset_dict:
+            self._transform_annotations(dataset_dict, transforms, image_shape)
+
+        return dataset_dict
+
+def load_or_build_image_cache(images, cache_dir, min_size=None, max_size=None, workers=8, rebuild=False):
+
+    # Reuses the cache in `cache_dir` if it has the same (unmodified) images and sizes, builds it otherwise
+
+    index_path = os.path.join(cache_dir, "index.json")
+    if not rebuild and os.path.isfile(index_path):
+        try:
+            cache = ImageCache(cache_dir)
+        except (OSError, ValueError, KeyError):
+            cache = None # A broken index means the cache is built again
+        if cache is not None and cache.is_valid(images, min_size, max_size):
+            return cache
+
+    return build_image_cache(images, cache_dir, min_size, max_size, workers)
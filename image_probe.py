@@ -0,0 +1,71 @@
+"""
+Reads the size and the number of channels of an image from its header only
+(the pixels are not decoded).
+"""
+
+import json, os
+from concurrent.futures import ThreadPoolExecutor
+import numpy
+from PIL import Image
+
+def probe_image(image_path):
+
+    # Returns (width, height, channels) of an image, reading only its header.
+    # Palette images count as 3 channels, since they are decoded to RGB.
+
+    with Image.open(image_path) as image:
+        width, height = image.size
+        channels = 3 if image.mode == "P" else len(image.getbands())
+
+    return width, height, channels
+
+def load_size_index(index_path):
+
+    # The size index maps every image path to [mtime, file size, width, height, channels]
+
+    if index_path is None or not os.path.isfile(index_path):
+        return {}
+    try:
+        with open(index_path, "r") as f:
+            return json.load(f)
+    except ValueError:
+        return {} # A broken index means every image is probed again
+
+def save_size_index(index, index_path):
+
+    temporary_path = "{}.{}.tmp".format(index_path, os.getpid())
+    try:
+        with open(temporary_path, "w") as f:
+            json.dump(index, f)
+        os.replace(temporary_path, index_path)
+    except OSError:
+        # The index is only an optimization (e.g. the folder may be read-only):
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+def probe_images(images_paths, workers=8, index_path=None, rebuild=False):
+
+    # Returns the (widths, heights, channels) arrays of every image of `images_paths`.
+    # The headers are read by `workers` threads. With `index_path`, the sizes are kept in a
+    # JSON index and an image is only probed again if its modification time or file size changed.
+
+    index = {} if rebuild else load_size_index(index_path)
+
+    def probe(image_path):
+        stat = os.stat(image_path)
+        entry = index.get(image_path)
+        if entry is not None and entry[:2] == [stat.st_mtime_ns, stat.st_size]:
+            return entry, False
+        return [stat.st_mtime_ns, stat.st_size, *probe_image(image_path)], True
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        results = list(executor.map(probe, images_paths))
+
+    sizes = numpy.array([ entry[2:] for entry, _ in results ], dtype=numpy.int32).reshape(-1, 3)
+
+    # Saving the index again only if some image was probed (the entries of other images are kept):
+    if index_path is not None and (rebuild or any(probed for _, probed in results)):
+        index.update(zip(images_paths, (entry for entry, _ in results)))
+        save_size_index(index, index_path)
+
+    return sizes[:, 0], sizes[:, 1], sizes[:, 2]
@@ -0,0 +1,439 @@
+# Everything `test.py` does: loading the test dataset, predicting it (in one process or in local shards) and
+# evaluating it. The other tools (`checkpoint_sweep.py`, `export_model.py`, `serve.py`, `cli.py`) reuse its functions.
+
+# Default libs
+import hashlib, json, os, sys, time, cv2, subprocess
+import numpy, torch
+
+# The progress bar is used in the last loop (You can modify it if you want to remove the dependency)
+from progressbar import ProgressBar
+
+# Detectron2 modules
+from detectron2.config import get_cfg
+from detectron2.evaluation import PascalVOCDetectionEvaluator, COCOEvaluator # Our evaluator
+
+# Our modules:
+from arguments import get_option, get_selection
+from dataset import Dataset, file_fingerprint
+from predictor import BatchPredictor, ExportedPredictor, make_batches, set_threads
+from pipeline import StageTimer, prefetch
+from profiling import StageProfiler
+from evaluation import ArrayEvaluator
+from predictions import PredictionsWriter, PredictionStoreWriter, ShardWriter, read_shard, image_prediction_dict, instances_to_arrays, arrays_to_instances
+
+dataset_name = "t" # Arbitrary name of the dataset.
+
+def load_dataset(dataset_info_path, use_cache, rebuild_cache, selection=None):
+
+    # Getting test dataset data:
+    dataset = Dataset(dataset_info_path, "TEST", use_cache=use_cache, rebuild_cache=rebuild_cache)
+
+    # Keeping only a slice of the dataset (`selection` : keyword arguments of `Dataset.select`):
+    if selection:
+        dataset = dataset.select(**selection)
+
+    # Inserting our dataset into the DatasetCatalog (necessary if we want to use it)
+    my_dataset = dataset.register(dataset_name)
+
+    return dataset, my_dataset
+
+def setup_cfg(test_info):
+
+    # Setting up cfg:
+    cfg = get_cfg()
+    cfg.merge_from_file(test_info["CFG_PATH"])
+    cfg.DATASETS.TRAIN = (dataset_name, )
+    cfg.DATASETS.TEST = (dataset_name, )
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = test_info["SCORE_THRESH_TEST"]
+    if test_info.get("STORE_RAW_PREDICTIONS", False):
+        # Predicting with a low threshold, the raw predictions are filtered later (see `threshold_sweep.py`):
+        cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = min(test_info.get("RAW_SCORE_THRESH", 0.05), test_info["SCORE_THRESH_TEST"])
+    cfg.MODEL.WEIGHTS = test_info["WEIGHTS_PATH"]
+
+    return cfg
+
+def setup_output_folder(test_info, cfg):
+
+    # Setting up output folder:
+    base_output_directory_name = "./infer_output"
+    output_folder_path = os.path.join(base_output_directory_name, test_info["OUTPUT_FOLDER"])
+    os.makedirs(output_folder_path, exist_ok=True) # Creating the output folder, if it doesn't exist.
+
+    # Saving the CFG to the output folder:
+    cfg_output_path = os.path.join(output_folder_path, "cfg.yaml") # Defining the output file path.
+    with open(cfg_output_path, "w") as f: f.write(str(cfg)) # Saving the cfg into the file.
+
+    os.makedirs(os.path.join(output_folder_path, "images"), exist_ok=True) # Creating the images folder, if it doesn't exist.
+
+    return output_folder_path
+
+def setup_evaluators(dataset, my_dataset, cfg, test_info, output_folder_path, profiler):
+
+    # Returns a dictionary with the evaluators, ready to receive predictions.
+    # With "NATIVE_EVAL" the ground truth is taken straight from the dataset arrays (no file is written).
+
+    if test_info.get("NATIVE_EVAL", False):
+        return { "native" : ArrayEvaluator(dataset) }
+
+    # Fixing the image for PASCAL evaluation:
+    for image in dataset.get():
+        image["image_id"] = os.path.splitext(os.path.split(image["image_id"])[-1])[0]
+
+    # Setting up the COCO evaluation. The ground truth file is streamed from the dataset arrays to the path where
+    # `COCOEvaluator` would convert it itself (with the same image and annotation IDs), so it is used as it is:
+    my_dataset.json_file = os.path.join(output_folder_path, "{}_coco_format.json".format(dataset_name))
+    with profiler.stage("coco_json"):
+        dataset.write_coco(my_dataset.json_file, image_ids=[ image["image_id"] for image in dataset.get() ], first_annotation_id=1)
+    coco_evaluator = COCOEvaluator(dataset_name, cfg, distributed=True, output_dir=output_folder_path)
+
+    # Setting up the PASCAL VOC evaluation:
+    my_dataset.dirname = os.path.join(output_folder_path, "PascalVOCAnnotations")
+    my_dataset.split = 'test'
+    my_dataset.year = 2012
+    with profiler.stage("to_pascal"):
+        dataset.to_pascal(my_dataset.dirname) # Converting the dataset to PASCAL VOC
+    pascal_evaluator = PascalVOCDetectionEvaluator(dataset_name)
+
+    coco_evaluator.reset()
+    pascal_evaluator.reset()
+
+    return { "coco" : coco_evaluator, "pascal" : pascal_evaluator }
+
+def dump_results(evaluators, output_folder_path, profiler):
+
+    # Evaluating the prediction and dumping the results of every metric to "<metric>_eval_results.json"
+
+    for name, evaluator in evaluators.items():
+
+        # The native evaluator computes both the COCO and the PASCAL VOC results:
+        with profiler.stage("{}_eval".format(name)):
+            results = evaluator.evaluate()
+        if name != "native":
+            results = { name : results }
+
+        for metric, metric_results in results.items():
+            results_file_path = os.path.join(output_folder_path, "{}_eval_results.json".format(metric))
+            with open(results_file_path, "w") as results_file:
+                json.dump(metric_results, results_file, indent=2)
+
+            print("{} EVALUATION FINISHED".format("PASCAL VOC" if metric == "pascal" else metric.upper()))
+
+def build_predictor(cfg, test_info):
+
+    # "BACKEND" : "eager" (default) runs the Detectron2 model,
+    # "torchscript" runs the model exported by `export_model.py` ("EXPORTED_MODEL_PATH")
+
+    backend = test_info.get("BACKEND", "eager")
+    if backend == "torchscript":
+        return ExportedPredictor(cfg, test_info["EXPORTED_MODEL_PATH"])
+    if backend != "eager":
+        raise ValueError("Unknown BACKEND: {}".format(backend))
+
+    return BatchPredictor(cfg)
+
+def predict(cfg, test_info, images, on_batch, profiler, predictor=None, read_image=cv2.imread):
+
+    # Predicts every image of `images` and calls `on_batch(batch_images, batch_outputs)`
+    # for every batch, with the outputs already moved to the CPU.
+    # `predictor` (optional) is an already built `BatchPredictor`,
+    # `read_image` returns the BGR image of a path (e.g. from an `ImageCache`).
+
+    if predictor is None:
+        with profiler.stage("predictor"):
+            predictor = build_predictor(cfg, test_info)
+    batches = make_batches(images, test_info.get("BATCH_SIZE", 1), test_info.get("GROUP_BY_ASPECT_RATIO", False))
+    timer = StageTimer() # Measures the loading, waiting and inference stages.
+
+    # Loading function used by the prefetching threads (decoding + resizing):
+    def load_input(image):
+        return predictor.preprocess(read_image(image["file_name"])) # Loading the image (with opencv, by default).
+
+    # Images are decoded and resized ahead of the model, in the same order they are predicted:
+    loaded_inputs = prefetch(
+            (images[i] for batch in batches for i in batch), load_input,
+            num_workers=test_info.get("NUM_WORKERS", 4), queue_depth=test_info.get("QUEUE_DEPTH", 16), timer=timer
+            )
+
+    pbar = ProgressBar()
+    with profiler.stage("inference"):
+        for batch in pbar(batches): # Predicting for every batch of images (Using a progress bar).
+            batch_images = [ images[i] for i in batch ]
+            batch_inputs = [ next(loaded_inputs) for _ in batch ] # Getting the already loaded images.
+            start = time.perf_counter()
+            with timer.measure("inference"):
+                batch_outputs = predictor.predict_inputs(batch_inputs) # Predicting the annotations of the whole batch at once.
+            del batch_inputs
+
+            # Moving the predictions to the CPU and handing them over right away:
+            batch_outputs = [ { "instances" : outputs["instances"].to("cpu") } for outputs in batch_outputs ]
+            profiler.add_latency(time.perf_counter() - start, len(batch)) # Latency per image (batch latency / batch size)
+            with timer.measure("evaluation"):
+                on_batch(batch_images, batch_outputs)
+
+        """
+        # Saving the prediction image:
+        from detectron2.data import MetadataCatalog
+        from detectron2.utils.visualizer import Visualizer
+        for image, outputs in zip(batch_images, batch_outputs):
+            img = cv2.imread(image["file_name"])
+            output_path = os.path.join(output_folder_path, "images", image["file_name"])
+            visualizer = Visualizer(img[:, :, ::-1], MetadataCatalog.get(cfg.DATASETS.TRAIN[0]), scale=1.0)
+            vis = visualizer.draw_instance_predictions(outputs["instances"])
+            cv2.imwrite(output_path, vis.get_image()[:, :, ::-1])
+        """
+
+    # Showing whether the inference was I/O-bound or compute-bound:
+    timer.report()
+    profiler.details["inference_breakdown"] = timer.summary()
+
+class PredictionOutputs:
+
+    # Writes the predictions of every image to the output folder:
+    # `predictions.json`, the binary store `predictions_bin/` (same content, memory-mappable)
+    # and, with "STORE_RAW_PREDICTIONS", every prediction below the threshold too (`raw_predictions/`).
+
+    def __init__(self, test_info, cfg, output_folder_path):
+
+        self.score_threshold = test_info["SCORE_THRESH_TEST"]
+
+        self.json_writer = None
+        if test_info.get("WRITE_JSON_PREDICTIONS", True):
+            self.json_writer = PredictionsWriter(os.path.join(output_folder_path, "predictions.json"))
+
+        self.binary_writer = PredictionStoreWriter(
+                os.path.join(output_folder_path, "predictions_bin"),
+                metadata={ "score_threshold" : self.score_threshold }, ground_truth=True
+                )
+
+        self.raw_writer = None
+        if test_info.get("STORE_RAW_PREDICTIONS", False):
+            self.raw_writer = PredictionStoreWriter(
+                    os.path.join(output_folder_path, "raw_predictions"),
+                    metadata={ "score_threshold" : cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST }
+                    )
+
+    def write(self, image, boxes, scores, classes):
+
+        # Writes the predictions of an image, returns the mask of the ones above the user set threshold
+
+        boxes = numpy.asarray(boxes, dtype=numpy.float32).reshape(-1, 4)
+        scores = numpy.asarray(scores, dtype=numpy.float32)
+        classes = numpy.asarray(classes, dtype=numpy.int32)
+
+        if self.raw_writer is not None:
+            self.raw_writer.write(image["file_name"], boxes, scores, classes)
+
+        keep = scores > self.score_threshold
+        boxes, scores, classes = boxes[keep], scores[keep], classes[keep]
+
+        if self.json_writer is not None:
+            self.json_writer.write(image_prediction_dict(image, boxes, classes))
+
+        gt_boxes = [ annotation["bbox"] for annotation in image["annotations"] ]
+        gt_classes = [ annotation["category_id"] for annotation in image["annotations"] ]
+        self.binary_writer.write(image["file_name"], boxes, scores, classes, numpy.reshape(gt_boxes, (-1, 4)), gt_classes)
+
+        return keep
+
+    def close(self):
+
+        for writer in (self.json_writer, self.binary_writer, self.raw_writer):
+            if writer is not None:
+                writer.close()
+
+def run_test(dataset, my_dataset, cfg, test_info, output_folder_path, profiler):
+
+    # Predicts and evaluates the whole dataset in this process
+
+    evaluators = setup_evaluators(dataset, my_dataset, cfg, test_info, output_folder_path, profiler)
+
+    # The predictions are written as they are predicted (nothing is kept in memory):
+    prediction_outputs = PredictionOutputs(test_info, cfg, output_folder_path)
+
+    def on_batch(batch_images, batch_outputs):
+
+        # Writing the predictions and keeping only the ones above the user set threshold:
+        filtered_outputs = []
+        for image, outputs in zip(batch_images, batch_outputs):
+            keep = prediction_outputs.write(image, *instances_to_arrays(outputs["instances"]))
+            filtered_outputs.append({ "instances" : outputs["instances"][torch.as_tensor(keep)] })
+
+        # Feeding the evaluators:
+        for evaluator in evaluators.values():
+            evaluator.process(batch_images, filtered_outputs)
+
+    predict(cfg, test_info, dataset.get(), on_batch, profiler)
+    with profiler.stage("write_predictions"): # The rest of the writing happens during the inference
+        prediction_outputs.close()
+
+    dump_results(evaluators, output_folder_path, profiler)
+
+def shard_path(output_folder_path, shard_index, num_shards):
+
+    # Returns the path to the partial predictions file of a shard
+
+    return os.path.join(output_folder_path, "shards", "shard_{:03d}_of_{:03d}.jsonl".format(shard_index, num_shards))
+
+def shard_header(dataset, test_info, selection):
+
+    # Identifies what the shards predict: the annotations CSV, the selected images (in order), the selection
+    # and the model. Shards written with another header are never resumed nor merged.
+
+    weights_path = test_info["WEIGHTS_PATH"]
+    header = {
+        "annotations" : file_fingerprint(dataset.annotations_file)["hash"],
+        "images" : hashlib.blake2b("\n".join(dataset.images_paths.tolist()).encode(), digest_size=16).hexdigest(),
+        "selection" : selection or {},
+        "weights" : weights_path,
+        "weights_file" : file_fingerprint(weights_path, content_hash=False) if os.path.isfile(weights_path) else None,
+        "backend" : test_info.get("BACKEND", "eager"),
+        "exported_model" : test_info.get("EXPORTED_MODEL_PATH")
+    }
+
+    return json.loads(json.dumps(header)) # As it is read back from the shard files
+
+def check_shard_records(records, images, file_path):
+
+    # Raises an error if a record doesn't belong to the image of its index
+
+    for record in records:
+        index = record["index"]
+        if not 0 <= index < len(images) or images[index]["file_name"] != record["image_name"]:
+            raise RuntimeError("{} has predictions of other images ({} at index {}), delete it to start over".format(
+                file_path, record["image_name"], index
+            ))
+
+def run_shard(dataset, cfg, test_info, output_folder_path, shard_index, num_shards, header, profiler):
+
+    # Predicts the `shard_index`-th slice of the dataset (out of `num_shards`).
+    # The predictions are written to a partial file, images already in it are skipped (resuming).
+    # `header` : see `shard_header`
+
+    images = dataset.get()
+    file_path = shard_path(output_folder_path, shard_index, num_shards)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+    # Sharing the CPU cores between the shards running at the same time (unless set in `test_info.json`):
+    if num_shards > 1 and not test_info.get("INTRA_OP_THREADS"):
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_shards))
+
+    with ShardWriter(file_path, header, checkpoint_every=test_info.get("CHECKPOINT_EVERY", 100)) as shard_writer:
+        check_shard_records([ { "index" : i, "image_name" : name } for i, name in shard_writer.done.items() ], images, file_path)
+
+        indices = [ i for i in range(shard_index, len(images), num_shards) if i not in shard_writer.done ]
+        print("Shard {}/{}: {} images to predict, {} already done".format(shard_index, num_shards, len(indices), len(shard_writer.done)))
+        index_of = { id(images[i]) : i for i in indices } # Maps the image dicts back to the dataset indices
+
+        def on_batch(batch_images, batch_outputs):
+            for image, outputs in zip(batch_images, batch_outputs):
+                boxes, scores, classes = instances_to_arrays(outputs["instances"])
+                shard_writer.write({
+                    "index" : index_of[id(image)],
+                    "image_name" : image["file_name"],
+                    "boxes" : boxes.tolist(),
+                    "scores" : scores.tolist(),
+                    "classes" : classes.tolist()
+                })
+
+        if indices:
+            predict(cfg, test_info, [ images[i] for i in indices ], on_batch, profiler)
+
+def launch_shards(args, num_shards):
+
+    # Starts one local worker process per shard (this same script) and waits for all of them
+
+    # The dataset cache was already (re)built by this process, the workers just load it:
+    worker_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test.py")
+    worker_args = [ sys.executable, worker_script ] + [ a for a in args[1:] if a != "--rebuild-cache" ]
+    workers = [
+        subprocess.Popen(worker_args + [ "--shard-index", str(shard_index) ])
+        for shard_index in range(num_shards)
+    ]
+    failed = [ shard_index for shard_index, worker in enumerate(workers) if worker.wait() != 0 ]
+    if failed:
+        raise RuntimeError("Shards {} failed, run the same command again to resume them".format(failed))
+
+def merge_shards(dataset, my_dataset, cfg, test_info, output_folder_path, num_shards, header, profiler):
+
+    # Combines the partial files into `predictions.json` and evaluates the predictions
+    # `header` : see `shard_header`, every shard must have been written with it
+
+    images = dataset.get()
+
+    # Reading the shards (the last record of an image wins):
+    records = {}
+    for shard_index in range(num_shards):
+        file_path = shard_path(output_folder_path, shard_index, num_shards)
+        file_header, shard_records, _ = read_shard(file_path)
+        if shard_records and file_header != header:
+            raise RuntimeError("{} was written for another dataset, selection or model, delete it to start over".format(file_path))
+        check_shard_records(shard_records, images, file_path)
+        for record in shard_records:
+            records[record["index"]] = record
+
+    missing = len(images) - len(records)
+    if missing:
+        raise RuntimeError("{} images have no predictions, run the missing shards first".format(missing))
+
+    evaluators = setup_evaluators(dataset, my_dataset, cfg, test_info, output_folder_path, profiler)
+
+    # The shards keep the scores, so every output of `run_test` can be written here:
+    with profiler.stage("write_predictions"):
+        prediction_outputs = PredictionOutputs(test_info, cfg, output_folder_path)
+        for i, image in enumerate(images):
+            record = records.pop(i)
+            keep = prediction_outputs.write(image, record["boxes"], record["scores"], record["classes"])
+
+            # Feeding the evaluators with the predictions above the user set threshold:
+            boxes = numpy.reshape(record["boxes"], (-1, 4))[keep]
+            scores = numpy.asarray(record["scores"])[keep]
+            classes = numpy.asarray(record["classes"])[keep]
+            instances = arrays_to_instances((image["height"], image["width"]), boxes, scores, classes)
+            for evaluator in evaluators.values():
+                evaluator.process([ image ], [ { "instances" : instances } ])
+
+        prediction_outputs.close()
+
+    dump_results(evaluators, output_folder_path, profiler)
+
+def main(args):
+
+    # Getting arguments from command-line:
+    dataset_info_path = args[1]
+    test_info_path = args[2]
+    use_cache = "--no-cache" not in args # Parses the CSV again without touching the dataset cache
+    rebuild_cache = "--rebuild-cache" in args # Parses the CSV again and overwrites the dataset cache
+    num_shards = int(get_option(args, "--num-shards", 1)) # Number of slices the dataset is split into
+    shard_index = get_option(args, "--shard-index") # Slice predicted by this process (worker mode)
+    merge_only = "--merge" in args # Only merges and evaluates the shards already predicted
+
+    # Getting test info:
+    with open(test_info_path, "r") as f:
+        test_info = json.load(f)
+    set_threads(test_info.get("INTRA_OP_THREADS", 0), test_info.get("INTER_OP_THREADS", 0)) # 0: PyTorch's default
+
+    # Measuring every stage (and running one of them under cProfile, if "PROFILE_STAGE" is set):
+    profiler = StageProfiler(test_info.get("PROFILE_STAGE") or None)
+
+    selection = get_selection(args)
+    with profiler.stage("dataset"):
+        dataset, my_dataset = load_dataset(dataset_info_path, use_cache, rebuild_cache, selection)
+    cfg = setup_cfg(test_info)
+    output_folder_path = setup_output_folder(test_info, cfg)
+
+    if shard_index is not None:
+        header = shard_header(dataset, test_info, selection)
+        run_shard(dataset, cfg, test_info, output_folder_path, int(shard_index), num_shards, header, profiler)
+    elif num_shards > 1:
+        if not merge_only:
+            with profiler.stage("shards"):
+                launch_shards(args, num_shards)
+        header = shard_header(dataset, test_info, selection)
+        merge_shards(dataset, my_dataset, cfg, test_info, output_folder_path, num_shards, header, profiler)
+    else:
+        run_test(dataset, my_dataset, cfg, test_info, output_folder_path, profiler)
+
+    # Saving the profile to the output folder (every shard worker has its own):
+    profiler.report()
+    profile_name = "profile.json" if shard_index is None else "profile_shard_{:03d}.json".format(int(shard_index))
+    profiler.save(os.path.join(output_folder_path, profile_name))
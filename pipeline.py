@@ -0,0 +1,93 @@
+"""
+A bounded producer/consumer pipeline: images are decoded (and preprocessed)
+by a pool of threads ahead of the model, so I/O and inference overlap.
+"""
+
+import threading, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+class StageTimer:
+
+    def __init__(self):
+
+        # `totals` keeps the accumulated seconds of every stage, `counts` the number of measures
+        self.totals = {}
+        self.counts = {}
+        self._lock = threading.Lock() # Stages may be measured from several threads
+
+    def add(self, stage, seconds):
+
+        with self._lock:
+            self.totals[stage] = self.totals.get(stage, 0.0) + seconds
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+
+    @contextmanager
+    def measure(self, stage):
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def summary(self):
+
+        # Returns a dictionary with the total and the mean time of every stage
+
+        return {
+            stage : { "total" : total, "mean" : total / self.counts[stage], "count" : self.counts[stage] }
+            for stage, total in self.totals.items()
+        }
+
+    def report(self, wait_stage="wait", compute_stage="inference"):
+
+        # Prints the stage timings and tells whether the consumer was starving (I/O-bound)
+
+        for stage, info in self.summary().items():
+            print("{:>12}: {:10.2f}s total, {:8.4f}s mean ({} calls)".format(stage, info["total"], info["mean"], info["count"]))
+
+        wait = self.totals.get(wait_stage, 0.0)
+        compute = self.totals.get(compute_stage, 0.0)
+        if wait + compute > 0:
+            bound = "I/O-bound" if wait > 0.1 * (wait + compute) else "compute-bound"
+            print("Waited for the loaders {:.1f}% of the time: {}".format(100 * wait / (wait + compute), bound))
+
+def prefetch(items, load_fn, num_workers=4, queue_depth=16, timer=None):
+
+    # Yields `load_fn(item)` for every item of `items`, in order.
+    # `num_workers` threads load the items ahead of the consumer, at most `queue_depth` at a time.
+    # `timer` (optional StageTimer) gets the "load" time (workers) and the "wait" time (consumer).
+
+    def timed_load(item):
+        start = time.perf_counter()
+        result = load_fn(item)
+        if timer is not None:
+            timer.add("load", time.perf_counter() - start)
+        return result
+
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=max(num_workers, 1)) as executor:
+
+        # Filling the queue:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(timed_load, item))
+            if len(pending) >= queue_depth:
+                break
+
+        while pending:
+
+            # Waiting for the oldest item (that's the time the consumer starves):
+            start = time.perf_counter()
+            result = pending.popleft().result()
+            if timer is not None:
+                timer.add("wait", time.perf_counter() - start)
+
+            # Keeping the queue full:
+            for item in items:
+                pending.append(executor.submit(timed_load, item))
+                break
+
+            yield result
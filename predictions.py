@@ -0,0 +1,304 @@
+"""
+Everything related to storing the predictions of `test.py`.
+"""
+
+import json, os
+import numpy
+
+def instances_to_arrays(instances):
+
+    # Converts a Detectron2 `Instances` object into compact CPU arrays:
+    # boxes (N, 4) float32 in XYXY_ABS, scores (N,) float32 and classes (N,) int32
+
+    instances = instances.to("cpu")
+    boxes = instances.pred_boxes.tensor.numpy().astype(numpy.float32)
+    scores = instances.scores.numpy().astype(numpy.float32)
+    classes = instances.pred_classes.numpy().astype(numpy.int32)
+
+    return boxes, scores, classes
+
+def image_prediction_dict(image, prediction_bboxes, prediction_classes):
+
+    # Returns the `predictions.json` entry of an image
+    # `prediction_bboxes` and `prediction_classes` are lists (or arrays) of the predicted boxes and classes
+
+    image_file_name = image["file_name"] # No more split
+
+    # Creating predicted data dictionaries:
+    predictions_dicts = [
+            { "category_id" : category, "bbox" : bbox }
+            for category, bbox in zip(numpy.asarray(prediction_classes).tolist(), numpy.asarray(prediction_bboxes).reshape(-1, 4).tolist())
+            ]
+
+    # Creating annotated data dictionaries:
+    annotated_dicts = [
+            { "category_id" : annotation["category_id"], "bbox" : annotation["bbox"] }
+            for annotation in image["annotations"]
+            ]
+
+    # Creating an image dict:
+    return {
+            "image_name" : image_file_name,
+            "predictions" : predictions_dicts,
+            "annotations" : annotated_dicts
+            }
+
+class PredictionsWriter:
+
+    # Writes a JSON list incrementally, one element at a time.
+    # The output is the same as `json.dump(elements, f, indent=2)`.
+
+    def __init__(self, file_path):
+
+        self.file = open(file_path, "w")
+        self.count = 0
+
+    def write(self, element):
+
+        text = json.dumps(element, indent=2).replace("\n", "\n  ")
+        self.file.write(("[\n  " if self.count == 0 else ",\n  ") + text)
+        self.count += 1
+
+    def close(self):
+
+        self.file.write("[]" if self.count == 0 else "\n]")
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def read_shard(file_path):
+
+    # Reads a partial predictions file (one JSON record per line, after a {"header" : ...} line).
+    # Returns the header (None if there is none), the records and the number of bytes that were
+    # read correctly: a line that was cut by a crash (and everything after it) is ignored.
+
+    header = None
+    records = []
+    valid_bytes = 0
+
+    if not os.path.isfile(file_path):
+        return header, records, valid_bytes
+
+    with open(file_path, "rb") as f:
+        for line in f:
+            try:
+                if not line.endswith(b"\n"):
+                    raise ValueError("Incomplete line")
+                record = json.loads(line)
+            except ValueError:
+                break
+            if valid_bytes == 0 and "header" in record:
+                header = record["header"]
+            else:
+                records.append(record)
+            valid_bytes += len(line)
+
+    return header, records, valid_bytes
+
+class ShardWriter:
+
+    # Appends records to a partial predictions file, one JSON record per line.
+    # The file is flushed to the disk every `checkpoint_every` records, so a
+    # crashed worker can resume from its last checkpoint.
+    # The first line is `header` (what the shard predicts: dataset, model...), a file
+    # written with another header is never resumed.
+
+    def __init__(self, file_path, header, checkpoint_every=100):
+
+        # Getting rid of any incomplete record left by a previous crash:
+        file_header, records, valid_bytes = read_shard(file_path)
+        if valid_bytes and file_header != header:
+            raise RuntimeError(
+                "{} was written for another dataset, selection or model, delete it to start over".format(file_path)
+            )
+        self.done = { record["index"] : record["image_name"] for record in records } # Images already predicted
+
+        self.file = open(file_path, "a")
+        self.file.truncate(valid_bytes)
+        if not valid_bytes:
+            self.file.write(json.dumps({ "header" : header }) + "\n")
+        self.checkpoint_every = checkpoint_every
+        self.pending = 0
+
+    def checkpoint(self):
+
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+
+    def write(self, record):
+
+        self.file.write(json.dumps(record) + "\n")
+        self.done[record["index"]] = record["image_name"]
+        self.pending += 1
+        if self.pending >= self.checkpoint_every:
+            self.checkpoint()
+
+    def close(self):
+
+        self.checkpoint()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def arrays_to_instances(image_size, boxes, scores, classes):
+
+    # Converts compact arrays back into a Detectron2 `Instances` object (used by the evaluators).
+    # Detectron2 and torch are only imported here, reading predictions doesn't need them.
+
+    import torch
+    from detectron2.structures import Boxes, Instances
+
+    instances = Instances(image_size)
+    instances.pred_boxes = Boxes(torch.as_tensor(numpy.asarray(boxes, dtype=numpy.float32).reshape(-1, 4)))
+    instances.scores = torch.as_tensor(numpy.asarray(scores, dtype=numpy.float32))
+    instances.pred_classes = torch.as_tensor(numpy.asarray(classes, dtype=numpy.int64))
+
+    return instances
+
+class PredictionStoreWriter:
+
+    # Writes the predictions (with scores) of every image into a columnar store:
+    # a directory with one flat binary file per column, plus the per-image offsets.
+    # The columns are appended as the images are predicted, nothing is kept in memory.
+    # The ground truth of every image can be stored the same way ("gt_" columns).
+
+    columns = {
+        "boxes" : (numpy.float32, (4,)), # XYXY_ABS
+        "scores" : (numpy.float32, ()),
+        "classes" : (numpy.int32, ()),
+        "gt_boxes" : (numpy.int32, (4,)),
+        "gt_classes" : (numpy.int32, ())
+    }
+
+    def __init__(self, directory, metadata=None, ground_truth=False):
+
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.metadata = metadata or {}
+        self.ground_truth = ground_truth
+        self.names = [ name for name in self.columns if ground_truth or not name.startswith("gt_") ]
+        self.files = { name : open(os.path.join(directory, name + ".bin"), "wb") for name in self.names }
+        self.names_file = open(os.path.join(directory, "image_names.txt"), "w")
+        self.counts = [] # Number of predictions of every image
+        self.gt_counts = [] # Number of ground truth boxes of every image
+
+    def write(self, image_name, boxes, scores, classes, gt_boxes=(), gt_classes=()):
+
+        values = { "boxes" : boxes, "scores" : scores, "classes" : classes, "gt_boxes" : gt_boxes, "gt_classes" : gt_classes }
+        for name in self.names:
+            dtype, _ = self.columns[name]
+            self.files[name].write(numpy.ascontiguousarray(values[name], dtype=dtype).tobytes())
+        self.names_file.write(image_name + "\n")
+        self.counts.append(len(scores))
+        self.gt_counts.append(len(gt_classes))
+
+    def close(self):
+
+        for f in self.files.values():
+            f.close()
+        self.names_file.close()
+
+        # The offsets and the metadata are written last: a store without them is incomplete.
+        offsets = {}
+        for offsets_name, counts in (("offsets", self.counts), ("gt_offsets", self.gt_counts)):
+            if offsets_name == "gt_offsets" and not self.ground_truth:
+                continue
+            offsets[offsets_name] = numpy.zeros(len(counts) + 1, dtype=numpy.int64)
+            numpy.cumsum(counts, out=offsets[offsets_name][1:])
+            numpy.save(os.path.join(self.directory, offsets_name + ".npy"), offsets[offsets_name])
+
+        metadata = dict(self.metadata)
+        metadata["columns"] = {}
+        for name in self.names:
+            dtype, shape = self.columns[name]
+            length = offsets["gt_offsets" if name.startswith("gt_") else "offsets"][-1]
+            metadata["columns"][name] = { "dtype" : numpy.dtype(dtype).str, "shape" : [ int(length) ] + list(shape) }
+        with open(os.path.join(self.directory, "metadata.json"), "w") as f:
+            json.dump(metadata, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class PredictionStore:
+
+    # Reads a store written by `PredictionStoreWriter`.
+    # The columns are memory-mapped, so only the images that are used are read from the disk.
+
+    def __init__(self, directory):
+
+        with open(os.path.join(directory, "metadata.json"), "r") as f:
+            self.metadata = json.load(f)
+
+        self.offsets = numpy.load(os.path.join(directory, "offsets.npy"))
+        gt_offsets_path = os.path.join(directory, "gt_offsets.npy")
+        self.gt_offsets = numpy.load(gt_offsets_path) if os.path.isfile(gt_offsets_path) else None
+        with open(os.path.join(directory, "image_names.txt"), "r") as f:
+            self.image_names = f.read().split("\n")[:len(self.offsets) - 1]
+
+        for name, info in self.metadata["columns"].items():
+            file_path = os.path.join(directory, name + ".bin")
+            if info["shape"][0] == 0:
+                column = numpy.zeros(info["shape"], dtype=info["dtype"]) # Empty files can't be memory-mapped
+            else:
+                column = numpy.memmap(file_path, dtype=info["dtype"], mode="r", shape=tuple(info["shape"]))
+            setattr(self, name, column)
+
+    def __len__(self):
+        return len(self.image_names)
+
+    def get(self, i, score_threshold=None):
+
+        # Returns the (boxes, scores, classes) of the i-th image, optionally keeping only the scores above a threshold
+
+        start, end = self.offsets[i], self.offsets[i + 1]
+        boxes, scores, classes = self.boxes[start:end], self.scores[start:end], self.classes[start:end]
+
+        if score_threshold is not None:
+            keep = scores > score_threshold
+            boxes, scores, classes = boxes[keep], scores[keep], classes[keep]
+
+        return boxes, scores, classes
+
+    def get_ground_truth(self, i):
+
+        # Returns the (boxes, classes) ground truth of the i-th image (if the store has it)
+
+        if self.gt_offsets is None:
+            raise ValueError("This store has no ground truth")
+
+        start, end = self.gt_offsets[i], self.gt_offsets[i + 1]
+        return self.gt_boxes[start:end], self.gt_classes[start:end]
+
+    def image_info(self, i):
+
+        # Returns the i-th image in the same format as the `predictions.json` entries
+
+        boxes, scores, classes = self.get(i)
+        info = {
+            "image_name" : self.image_names[i],
+            "predictions" : [
+                { "category_id" : category, "bbox" : bbox, "score" : score }
+                for category, bbox, score in zip(classes.tolist(), boxes.tolist(), scores.tolist())
+                ],
+            "annotations" : []
+        }
+        if self.gt_offsets is not None:
+            gt_boxes, gt_classes = self.get_ground_truth(i)
+            info["annotations"] = [
+                { "category_id" : category, "bbox" : bbox }
+                for category, bbox in zip(gt_classes.tolist(), gt_boxes.tolist())
+                ]
+
+        return info
@@ -0,0 +1,120 @@
+"""
+Batched inference: `DefaultPredictor` runs one image per forward pass,
+`BatchPredictor` does the same preprocessing but runs a list of images
+through the model at once. `ExportedPredictor` runs a model exported
+by `export_model.py` (TorchScript) with the same interface.
+"""
+
+import torch
+
+import detectron2.data.transforms as T
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.data import MetadataCatalog
+from detectron2.modeling import build_model
+from detectron2.modeling.postprocessing import detector_postprocess
+from detectron2.structures import Boxes, Instances
+
+def set_threads(intra_op_threads=0, inter_op_threads=0):
+
+    # Sets the number of threads used inside an operator (intra-op) and between operators (inter-op).
+    # 0 keeps PyTorch's default. The inter-op threads must be set before any parallel work starts.
+
+    if intra_op_threads:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads:
+        torch.set_num_interop_threads(inter_op_threads)
+
+def make_batches(images, batch_size, group_by_aspect_ratio=False):
+
+    # Returns a list of batches, every batch is a list of indices of `images`
+    # `images` : list of Detectron2-format dicts (only "height" and "width" are used)
+    # `group_by_aspect_ratio` : if True, images with similar aspect ratios share a batch
+
+    if batch_size < 1:
+        raise ValueError("The batch size must be at least 1 (got {})".format(batch_size))
+
+    indices = list(range(len(images)))
+
+    if group_by_aspect_ratio:
+        indices.sort(key=lambda i: images[i]["width"] / max(images[i]["height"], 1))
+
+    return [ indices[i:i + batch_size] for i in range(0, len(indices), batch_size) ]
+
+class BatchPredictor:
+
+    def __init__(self, cfg):
+
+        # Building the model the same way `DefaultPredictor` does:
+        self.cfg = cfg.clone()
+        self.model = build_model(self.cfg)
+        self.model.eval()
+        if len(cfg.DATASETS.TEST):
+            self.metadata = MetadataCatalog.get(cfg.DATASETS.TEST[0])
+
+        checkpointer = DetectionCheckpointer(self.model)
+        checkpointer.load(cfg.MODEL.WEIGHTS)
+
+        self._setup_preprocessing(cfg)
+
+    def _setup_preprocessing(self, cfg):
+
+        self.aug = T.ResizeShortestEdge(
+            [cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST], cfg.INPUT.MAX_SIZE_TEST
+        )
+
+        self.input_format = cfg.INPUT.FORMAT
+        assert self.input_format in ["RGB", "BGR"], self.input_format
+
+    def preprocess(self, original_image):
+
+        # Converts an opencv (BGR) image into a model input dict
+
+        if self.input_format == "RGB":
+            original_image = original_image[:, :, ::-1]
+        height, width = original_image.shape[:2]
+        image = self.aug.get_transform(original_image).apply_image(original_image)
+        image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+
+        return { "image" : image, "height" : height, "width" : width }
+
+    def predict_inputs(self, inputs):
+
+        # Runs a single forward pass for a list of already preprocessed inputs
+
+        with torch.no_grad():
+            return self.model(inputs)
+
+    def __call__(self, original_images):
+
+        # Returns one {"instances" : Instances} dict for every image of `original_images`
+
+        return self.predict_inputs([ self.preprocess(image) for image in original_images ])
+
+class ExportedPredictor(BatchPredictor):
+
+    # Same interface as `BatchPredictor`, but the model is a TorchScript file written by `export_model.py`.
+    # The exported model takes one preprocessed image and returns (boxes, scores, classes) in the
+    # coordinates of the resized image, they are scaled back to the original image here.
+
+    def __init__(self, cfg, model_path):
+
+        self.cfg = cfg.clone()
+        self.model = torch.jit.load(model_path, map_location="cpu")
+        self.model.eval()
+        if len(cfg.DATASETS.TEST):
+            self.metadata = MetadataCatalog.get(cfg.DATASETS.TEST[0])
+
+        self._setup_preprocessing(cfg)
+
+    def predict_inputs(self, inputs):
+
+        # The traced model runs one image at a time
+
+        outputs = []
+        with torch.no_grad():
+            for inp in inputs:
+                boxes, scores, classes = self.model(inp["image"])
+                instances = Instances(tuple(inp["image"].shape[1:]), pred_boxes=Boxes(boxes), scores=scores, pred_classes=classes)
+                outputs.append({ "instances" : detector_postprocess(instances, inp["height"], inp["width"]) })
+
+        return outputs
@@ -0,0 +1,103 @@
+"""
+Resource usage helpers shared by the training and testing instrumentation.
+"""
+
+import cProfile, json, resource, sys, time
+from contextlib import contextmanager
+import numpy
+
+def peak_rss_mb(children=False):
+
+    # Returns the peak resident set size of this process (or of its finished children) in MiB
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+
+    # `ru_maxrss` is in KiB on Linux and in bytes on macOS:
+    return usage.ru_maxrss / (1 << 20 if sys.platform == "darwin" else 1 << 10)
+
+class StageProfiler:
+
+    def __init__(self, cprofile_stage=None):
+
+        # `stages` keeps the wall time, CPU time and peak RSS of every stage (in the order they ran)
+        # `cprofile_stage` (optional) is the name of a stage that also runs under cProfile
+        self.stages = {}
+        self.latencies = [] # Seconds, one per image
+        self.details = {} # Anything else saved in the profile (e.g. the stage breakdown of a `StageTimer`)
+        self.cprofile_stage = cprofile_stage
+        self.cprofile = None
+
+    @contextmanager
+    def stage(self, name):
+
+        # Measures the code of the `with` block. A stage that runs several times is accumulated.
+        # The peak RSS is the process high-water mark at the end of the stage, so "peak_rss_growth_mb"
+        # tells how much the stage itself raised it.
+
+        profile = None
+        if name == self.cprofile_stage:
+            profile = self.cprofile = self.cprofile or cProfile.Profile()
+            profile.enable()
+
+        peak_before = peak_rss_mb()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            if profile is not None:
+                profile.disable()
+
+            info = self.stages.setdefault(name, { "wall" : 0.0, "cpu" : 0.0, "calls" : 0, "peak_rss_growth_mb" : 0.0 })
+            info["wall"] += wall
+            info["cpu"] += cpu
+            info["calls"] += 1
+            info["peak_rss_mb"] = peak_rss_mb()
+            info["peak_rss_growth_mb"] += info["peak_rss_mb"] - peak_before
+
+    def add_latency(self, seconds, count=1):
+
+        # Adds the latency of `count` images predicted together (each one gets an equal share)
+
+        self.latencies.extend([ seconds / count ] * count)
+
+    def latency_percentiles(self):
+
+        # Returns the p50/p95/p99 (and mean) per-image latency in milliseconds
+
+        if not self.latencies:
+            return {}
+        latencies = 1000 * numpy.asarray(self.latencies)
+        p50, p95, p99 = numpy.percentile(latencies, [50, 95, 99]).tolist()
+
+        return { "p50_ms" : p50, "p95_ms" : p95, "p99_ms" : p99, "mean_ms" : float(latencies.mean()), "images" : len(latencies) }
+
+    def report(self):
+
+        for name, info in self.stages.items():
+            print("{:>16}: {:9.2f}s wall, {:9.2f}s CPU, peak RSS {:8.0f} MiB (+{:.0f})".format(
+                name, info["wall"], info["cpu"], info["peak_rss_mb"], info["peak_rss_growth_mb"]
+            ))
+        latencies = self.latency_percentiles()
+        if latencies:
+            print("Latency per image: p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms".format(
+                latencies["p50_ms"], latencies["p95_ms"], latencies["p99_ms"]
+            ))
+
+    def save(self, file_path):
+
+        # Writes the profile as JSON to `file_path`.
+        # The cProfile statistics go to "<file_path without .json>_<stage>.prof" (see `pstats` or `snakeviz`).
+
+        profile = {
+            "stages" : self.stages,
+            "latency" : self.latency_percentiles(),
+            "peak_rss_mb" : peak_rss_mb(),
+            "peak_rss_children_mb" : peak_rss_mb(children=True) # Finished worker processes (e.g. shards)
+        }
+        profile.update(self.details)
+        with open(file_path, "w") as f:
+            json.dump(profile, f, indent=2)
+
+        if self.cprofile is not None:
+            self.cprofile.dump_stats("{}_{}.prof".format(file_path.rsplit(".json", 1)[0], self.cprofile_stage))
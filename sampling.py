@@ -0,0 +1,134 @@
+"""
+Training batches grouped by image size: a batch is padded up to its largest
+image, so images of similar (resized) size and aspect ratio are batched together.
+"""
+
+import math
+import numpy, torch
+
+from detectron2.data.common import DatasetFromList, MapDataset
+from detectron2.data.build import trivial_batch_collator, worker_init_reset_seed
+
+def resized_shapes(widths, heights, min_size=None, max_size=None):
+
+    # Returns the (widths, heights) of the images after Detectron2's `ResizeShortestEdge`
+    # (shortest edge `min_size`, longest edge at most `max_size`). Not resized if `min_size` is None.
+
+    widths = numpy.asarray(widths, dtype=numpy.float64)
+    heights = numpy.asarray(heights, dtype=numpy.float64)
+    if not min_size:
+        return widths, heights
+
+    scales = min_size / numpy.minimum(widths, heights)
+    if max_size:
+        scales = numpy.minimum(scales, max_size / numpy.maximum(widths, heights))
+
+    return numpy.floor(widths * scales + 0.5), numpy.floor(heights * scales + 0.5)
+
+def bucket_keys(widths, heights, step=64):
+
+    # Images whose (width, height) round up to the same multiple of `step` pixels share a bucket.
+    # The bucket tells both the size and the aspect ratio of its images.
+
+    columns = numpy.ceil(numpy.asarray(widths) / step).astype(numpy.int64)
+    rows = numpy.ceil(numpy.asarray(heights) / step).astype(numpy.int64)
+    _, keys = numpy.unique(numpy.stack((rows, columns), axis=1), axis=0, return_inverse=True)
+
+    return keys.reshape(-1)
+
+def orientation_keys(widths, heights):
+
+    # Detectron2's default grouping (`ASPECT_RATIO_GROUPING`): landscape and portrait images
+
+    return (numpy.asarray(widths) > numpy.asarray(heights)).astype(numpy.int64)
+
+def grouped_batches(keys, batch_size, seed=0, shuffle=True):
+
+    # Infinite stream of batches (lists of indices) whose images have the same key.
+    # The indices are visited in a new random order every epoch, every key has its own
+    # buffer and a batch is yielded as soon as its buffer is full (like Detectron2's
+    # `AspectRatioGroupedDataset`, but with any number of groups).
+
+    keys = numpy.asarray(keys)
+    generator = numpy.random.default_rng(seed)
+    buckets = {}
+
+    while True:
+        order = generator.permutation(len(keys)) if shuffle else numpy.arange(len(keys))
+        for i in order.tolist():
+            bucket = buckets.setdefault(keys[i], [])
+            bucket.append(i)
+            if len(bucket) == batch_size:
+                yield bucket
+                buckets[keys[i]] = []
+
+def padding_overhead(widths, heights, batches, size_divisibility=0):
+
+    # Returns the fraction of the padded batch pixels that are padding
+
+    widths, heights = numpy.asarray(widths), numpy.asarray(heights)
+    image_pixels, batch_pixels = 0.0, 0.0
+
+    for batch in batches:
+        batch_width, batch_height = widths[batch].max(), heights[batch].max()
+        if size_divisibility > 1:
+            batch_width = math.ceil(batch_width / size_divisibility) * size_divisibility
+            batch_height = math.ceil(batch_height / size_divisibility) * size_divisibility
+        image_pixels += float((widths[batch] * heights[batch]).sum())
+        batch_pixels += float(batch_width * batch_height * len(batch))
+
+    return 1.0 - image_pixels / batch_pixels if batch_pixels else 0.0
+
+class BucketedBatchSampler(torch.utils.data.Sampler):
+
+    # Batch sampler for a `DataLoader`: infinite batches of images from the same size bucket
+
+    def __init__(self, widths, heights, batch_size, min_size=None, max_size=None, step=64, seed=None):
+
+        # `widths`/`heights` are the real image sizes (see `Dataset.read_image_sizes`),
+        # `min_size`/`max_size` the training resize (the buckets are made from the resized sizes)
+
+        self.widths, self.heights = resized_shapes(widths, heights, min_size, max_size)
+        self.keys = bucket_keys(self.widths, self.heights, step)
+        self.batch_size = batch_size
+        self.seed = int(torch.randint(1 << 31, (1,)).item()) if seed is None else seed
+
+    def __iter__(self):
+        return grouped_batches(self.keys, self.batch_size, self.seed)
+
+    def padding_report(self, default_keys=None, num_batches=None, size_divisibility=0):
+
+        # Compares the padding of the bucketed batches with the padding of `default_keys`
+        # (default: Detectron2's landscape/portrait grouping) over `num_batches` batches (default: 1 epoch)
+
+        if default_keys is None:
+            default_keys = orientation_keys(self.widths, self.heights)
+        if num_batches is None:
+            num_batches = max(len(self.keys) // self.batch_size, 1)
+
+        def overhead(keys):
+            stream = grouped_batches(keys, self.batch_size, self.seed)
+            batches = [ next(stream) for _ in range(num_batches) ]
+            return padding_overhead(self.widths, self.heights, batches, size_divisibility)
+
+        before, after = overhead(default_keys), overhead(self.keys)
+        print("Padding overhead: {:.1f}% before, {:.1f}% after bucketing ({} buckets)".format(
+            100 * before, 100 * after, len(numpy.unique(self.keys))
+        ))
+
+        return before, after
+
+def build_bucketed_train_loader(dataset_dicts, mapper, batch_sampler, num_workers):
+
+    # Same as `build_detection_train_loader`, but the batches come from `batch_sampler`.
+    # `dataset_dicts` must be in the same order as the sizes given to the sampler.
+
+    dataset = MapDataset(DatasetFromList(dataset_dicts, copy=False), mapper)
+
+    return torch.utils.data.DataLoader(
+        dataset,
+        batch_sampler=batch_sampler,
+        num_workers=num_workers,
+        collate_fn=trivial_batch_collator,
+        worker_init_fn=worker_init_reset_seed
+    )
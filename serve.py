@@ -0,0 +1,226 @@
+# This script keeps the model of `test_info.json` loaded and predicts the images posted to a local HTTP server.
+# Concurrent requests are grouped into micro-batches (at most --max-batch-size images, waiting at most --max-wait-ms
+# for a batch to fill up) and every batch runs through the model in a single forward pass.
+# Usage: python3 serve.py test_info.json [--host 127.0.0.1] [--port 8080] [--max-batch-size 8] [--max-wait-ms 10] [--timeout 30]
+#   POST /predict (body: the encoded image, e.g. a JPEG file) -> {"boxes" : [[x0, y0, x1, y1], ...], "scores" : [...], "classes" : [...]}
+#   GET /metrics -> queue depth, batch size histogram and latency percentiles
+# See `extra_tools/load_client.py` for a load testing client.
+
+import argparse, json, queue, threading, time, traceback
+from collections import deque
+from concurrent.futures import Future, TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import cv2, numpy
+
+# Our modules:
+from inference import setup_cfg, build_predictor
+from predictor import set_threads
+from predictions import instances_to_arrays
+
+class ServerMetrics:
+
+    def __init__(self, window=10000):
+
+        # The latencies of the last `window` requests are kept (seconds)
+        self.requests = 0
+        self.errors = 0
+        self.batch_sizes = {} # Batch size -> number of batches
+        self.latencies = deque(maxlen=window) # From the request arrival to its response
+        self.queue_waits = deque(maxlen=window) # From the request arrival to its batch start
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def add_batch(self, size, queue_waits):
+
+        with self._lock:
+            self.batch_sizes[size] = self.batch_sizes.get(size, 0) + 1
+            self.queue_waits.extend(queue_waits)
+
+    def add_request(self, latency, error=False):
+
+        with self._lock:
+            self.requests += 1
+            self.errors += error
+            self.latencies.append(latency)
+
+    def summary(self, queue_depth):
+
+        def percentiles(values):
+            if not values:
+                return {}
+            p50, p95, p99 = numpy.percentile(1000 * numpy.asarray(values), [50, 95, 99]).tolist()
+            return { "p50_ms" : p50, "p95_ms" : p95, "p99_ms" : p99 }
+
+        with self._lock:
+            batches = sum(self.batch_sizes.values())
+            return {
+                "queue_depth" : queue_depth,
+                "requests" : self.requests,
+                "errors" : self.errors,
+                "uptime_s" : time.time() - self.started,
+                "batches" : batches,
+                "mean_batch_size" : sum(size * count for size, count in self.batch_sizes.items()) / batches if batches else 0.0,
+                "batch_size_histogram" : { str(size) : count for size, count in sorted(self.batch_sizes.items()) },
+                "latency" : percentiles(list(self.latencies)),
+                "queue_wait" : percentiles(list(self.queue_waits))
+            }
+
+class MicroBatcher:
+
+    # Collects the submitted inputs into batches and runs them through `predictor` from a single thread
+
+    def __init__(self, predictor, max_batch_size=8, max_wait=0.01, metrics=None):
+
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait # Seconds a batch waits for more inputs after its first one
+        self.metrics = metrics or ServerMetrics()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, model_input):
+
+        # Returns a `Future` that gets the {"instances" : Instances} output of `model_input`
+
+        future = Future()
+        self.queue.put((model_input, future, time.perf_counter()))
+        return future
+
+    def _next_batch(self):
+
+        # Blocks until an input arrives, then takes more inputs until the batch is full or `max_wait` is over
+
+        batch = [ self.queue.get() ]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+
+        while True:
+            batch = self._next_batch()
+            start = time.perf_counter()
+            self.metrics.add_batch(len(batch), [ start - arrival for _, _, arrival in batch ])
+            try:
+                outputs = self.predictor.predict_inputs([ model_input for model_input, _, _ in batch ])
+                for (_, future, _), output in zip(batch, outputs):
+                    future.set_result({ "instances" : output["instances"].to("cpu") })
+            except Exception as e:
+                # The batcher thread must survive, every request of the batch still waiting gets the error:
+                traceback.print_exc()
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+class PredictionServer(ThreadingHTTPServer):
+
+    request_queue_size = 128 # The default (5) makes concurrent clients wait for TCP retries
+    daemon_threads = True
+
+def make_handler(batcher, score_threshold, timeout=30.0):
+
+    class PredictionHandler(BaseHTTPRequestHandler):
+
+        def _send_json(self, status, content):
+
+            body = json.dumps(content).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+
+            if self.path == "/metrics":
+                self._send_json(200, batcher.metrics.summary(batcher.queue.qsize()))
+            elif self.path == "/health":
+                self._send_json(200, { "status" : "ok" })
+            else:
+                self._send_json(404, { "error" : "not found" })
+
+        def do_POST(self):
+
+            if self.path != "/predict":
+                self._send_json(404, { "error" : "not found" })
+                return
+
+            arrival = time.perf_counter()
+            data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            # Decoding and preprocessing run in the request threads, only the model runs in the batcher:
+            image = cv2.imdecode(numpy.frombuffer(data, dtype=numpy.uint8), cv2.IMREAD_COLOR)
+            if image is None:
+                batcher.metrics.add_request(time.perf_counter() - arrival, error=True)
+                self._send_json(400, { "error" : "the body is not an image" })
+                return
+
+            try:
+                outputs = batcher.submit(batcher.predictor.preprocess(image)).result(timeout=timeout)
+            except TimeoutError:
+                batcher.metrics.add_request(time.perf_counter() - arrival, error=True)
+                self._send_json(504, { "error" : "the prediction took more than {} s".format(timeout) })
+                return
+            except Exception as e:
+                batcher.metrics.add_request(time.perf_counter() - arrival, error=True)
+                self._send_json(500, { "error" : repr(e) })
+                return
+
+            boxes, scores, classes = instances_to_arrays(outputs["instances"])
+            keep = scores > score_threshold
+            batcher.metrics.add_request(time.perf_counter() - arrival)
+            self._send_json(200, {
+                "boxes" : boxes[keep].tolist(),
+                "scores" : scores[keep].tolist(),
+                "classes" : classes[keep].tolist()
+            })
+
+        def log_message(self, format, *args):
+            pass # No line per request
+
+    return PredictionHandler
+
+def get_arguments():
+
+    parser = argparse.ArgumentParser(description="Serves the predictions of the model of `test_info.json` over local HTTP.")
+    parser.add_argument("test_info", help="The `test_info.json` file (\"BACKEND\" and the thread settings are used too)")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (local only by default)")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument("--max-batch-size", type=int, default=8, help="Maximum number of images per forward pass")
+    parser.add_argument("--max-wait-ms", type=float, default=10.0, help="Maximum time a batch waits to fill up")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Seconds a request waits for its prediction (then 504)")
+
+    return parser.parse_args()
+
+def main():
+
+    args = get_arguments()
+    with open(args.test_info, "r") as f:
+        test_info = json.load(f)
+    set_threads(test_info.get("INTRA_OP_THREADS", 0), test_info.get("INTER_OP_THREADS", 0))
+
+    # Loading the model once:
+    cfg = setup_cfg(test_info)
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = test_info["SCORE_THRESH_TEST"]
+    batcher = MicroBatcher(build_predictor(cfg, test_info), args.max_batch_size, args.max_wait_ms / 1000)
+
+    server = PredictionServer((args.host, args.port), make_handler(batcher, test_info["SCORE_THRESH_TEST"], args.timeout))
+    print("Serving on http://{}:{} (POST /predict, GET /metrics)".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
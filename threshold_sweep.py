@@ -0,0 +1,103 @@
+# This script recomputes the COCO/PASCAL VOC metrics and `predictions.json` for a list of score thresholds,
+# using the raw predictions stored by `test.py` (with "STORE_RAW_PREDICTIONS" : true), without predicting again.
+# Usage: python3 threshold_sweep.py dataset_info.json raw_predictions_dir THRESHOLD [THRESHOLD ...] [--no-json]
+#   [--categories A,B] [--path-prefix P] [--sample N]
+# Only the images of the store are evaluated (e.g. the ones of a `test.py --sample N` run), the selection options
+# narrow them down further.
+
+import json, os, sys
+import numpy
+
+# Our modules:
+from arguments import get_selection
+from dataset import Dataset
+from evaluation import ArrayEvaluator
+from predictions import PredictionStore, PredictionsWriter, image_prediction_dict
+
+def sweep(dataset, store, thresholds, output_folder_path, write_json=True):
+
+    # Evaluates the stored predictions at every threshold, returns {threshold : results}
+
+    images = dataset.get()
+    evaluator = ArrayEvaluator(dataset)
+    # The stored images left out of `dataset` (see `stored_images`) are skipped:
+    images_indices = [ evaluator.images_indices.get(name) for name in store.image_names ]
+
+    if min(thresholds) < store.metadata.get("score_threshold", 0.0):
+        print("WARNING: the predictions were stored with a score threshold of {}".format(store.metadata["score_threshold"]))
+
+    all_results = {}
+    for threshold in thresholds:
+        threshold_folder = os.path.join(output_folder_path, "threshold_{:.3f}".format(threshold))
+        os.makedirs(threshold_folder, exist_ok=True)
+
+        # Keeping the predictions above the threshold (for every image at once):
+        keep = numpy.asarray(store.scores) > threshold
+        kept_before = numpy.concatenate(([0], numpy.cumsum(keep)))
+        boxes, scores, classes = store.boxes[keep], store.scores[keep], store.classes[keep]
+        offsets = kept_before[store.offsets]
+
+        evaluator.reset()
+        writer = PredictionsWriter(os.path.join(threshold_folder, "predictions.json")) if write_json else None
+        for i, image_index in enumerate(images_indices):
+            if image_index is None:
+                continue
+            start, end = offsets[i], offsets[i + 1]
+            evaluator.add(image_index, boxes[start:end], scores[start:end], classes[start:end])
+            if writer is not None:
+                writer.write(image_prediction_dict(images[image_index], boxes[start:end], classes[start:end]))
+        if writer is not None:
+            writer.close()
+
+        # Dumping the results in the same files as `test.py`:
+        results = evaluator.evaluate()
+        for metric, metric_results in results.items():
+            with open(os.path.join(threshold_folder, "{}_eval_results.json".format(metric)), "w") as results_file:
+                json.dump(metric_results, results_file, indent=2)
+
+        all_results[threshold] = results
+        print("threshold {:.3f}: COCO AP {:.2f}, AP50 {:.2f} | VOC AP {:.2f}, AP50 {:.2f}".format(
+            threshold,
+            results["coco"]["bbox"]["AP"], results["coco"]["bbox"]["AP50"],
+            results["pascal"]["bbox"]["AP"], results["pascal"]["bbox"]["AP50"]
+        ))
+
+    return all_results
+
+def stored_images(dataset, store):
+
+    # Returns a view of the images of `dataset` that have predictions in `store`: the ground truth of the
+    # images that were never predicted would count as missed detections
+
+    stored = set(store.image_names)
+    indices = [ i for i, path in enumerate(dataset.get_images_paths()) if path in stored ]
+    if not indices:
+        raise ValueError("None of the stored images is in the dataset")
+
+    return dataset.view(indices) if len(indices) < len(dataset.images_paths) else dataset
+
+def main(args):
+
+    # Getting the arguments from the command-line:
+    dataset_info_path = args[1]
+    store_path = args[2]
+    options_with_values = ("--categories", "--path-prefix", "--sample")
+    thresholds = [
+        float(a) for i, a in enumerate(args[3:], 3) if not a.startswith("--") and args[i - 1] not in options_with_values
+    ]
+    write_json = "--no-json" not in args # Skips writing a `predictions.json` per threshold
+    if not thresholds:
+        sys.exit("Usage: python3 threshold_sweep.py dataset_info.json raw_predictions_dir THRESHOLD [THRESHOLD ...] [--no-json]")
+
+    store = PredictionStore(store_path)
+    dataset = stored_images(Dataset(dataset_info_path, "TEST").select(**get_selection(args)), store)
+
+    output_folder_path = os.path.join(os.path.dirname(os.path.abspath(store_path)), "threshold_sweep")
+    results = sweep(dataset, store, thresholds, output_folder_path, write_json)
+
+    # Saving a summary of every threshold:
+    with open(os.path.join(output_folder_path, "sweep_results.json"), "w") as f:
+        json.dump({ "{:.3f}".format(t) : r for t, r in results.items() }, f, indent=2)
+
+if __name__ == "__main__":
+    main(sys.argv)
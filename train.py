@@ -1,95 +1,161 @@
 # Default libs
-import json, os, sys, random, time, cv2
-from datetime import datetime
+import json, os, sys
 
 # Detectron2 modules
-from detectron2.structures import BoxMode
 from detectron2.data import DatasetCatalog, MetadataCatalog
 from detectron2.config import get_cfg
-from detectron2.utils.visualizer import Visualizer
 from detectron2.engine import DefaultTrainer
+from detectron2.data import build_detection_train_loader, DatasetMapper
 from detectron2 import model_zoo
 
 # Our modules
 from dataset import Dataset
+from image_cache import CachedDatasetMapper, load_or_build_image_cache
+from sampling import BucketedBatchSampler, build_bucketed_train_loader
+from hooks import ThroughputHook
+from arguments import get_selection
 
-# BoxMode is an enum that tells how the bounding box coordinates are read.
 # DatasetCatalog and MetadataCatalog are responsible for keeping the dataset register.
 # get_cfg allow us to start a cfg.
-# Visualizer contains some visualization tools (as the name suggests), it is not gonna be really used here.
 # DefaultTrainer is the model trainer we are going to use.
 # model_zoo is a really useful tool that allow us to quickly export cfg and ckpt files from the web.
 
-# Getting the path to configuration files (from command-line):
-args = sys.argv
-dataset_info_file_path = args[1] # This file will allow us to configure the dataset
-train_info_file_path = args[2] # This file will allow us to configure the train
-
 # Defining a few constants:
 dataset_name = "m" # If you change this name errors may occur.
 # TODO: Find out why the only dataset name accepted is "m"
 
-# Importing our dataset:
-train_dataset = Dataset(dataset_info_file_path, "TRAIN")
-
-# Defining our `get_dicts` function:
-def get_dicts():
-    return train_dataset.get()
-# The `get_dicts` function is a must, without it we can't register our dataset to the catalog
-
-# Inserting our dataset into the DatasetCatalog (necessary if we want to use it)
-DatasetCatalog.register(dataset_name, get_dicts)
-my_dataset = MetadataCatalog.get(dataset_name)
-my_dataset.image_root = train_dataset.base_dir
-my_dataset.thing_classes = list(train_dataset.categories_dict.keys())
-
-"""
-The following commented code is for testing purposes only,
-it allows us to verify if everything is alright with our dataset register.
-"""
-"""
-dataset_dicts = DatasetCatalog.get(dataset_name)
-for d in random.sample(dataset_dicts, 3):
-    img = cv2.imread(d["file_name"])
-    visualizer = Visualizer(img[:, :, ::-1], metadata=my_dataset, scale=0.5)
-    vis = visualizer.draw_dataset_dict(d)
-    cv2.imwrite("myimage.jpg", vis.get_image()[:, :, ::-1])
-"""
-
-# Opening the train configuration file:
-with open(train_info_file_path, "r") as f:
-    train_settings = json.load(f)
-
-# Defining the output directory:
-default_output_directory = "./output" # Every output will be under './output'.
-user_set_output_directory = train_settings["OUTPUT_DIR"]
-train_output_directory = os.path.join(default_output_directory, user_set_output_directory)
-
-# Setting the CFG file output path:
-cfg_file_output = os.path.join(train_output_directory, "cfg.yaml")
-
-# Setting up the CFG:
-cfg = get_cfg()
-cfg.merge_from_file(model_zoo.get_config_file("COCO-Detection/faster_rcnn_R_101_C4_3x.yaml"))
-cfg.DATASETS.TRAIN = (dataset_name, )
-cfg.DATASETS.TEST = () # No test dataset in use right now
-cfg.DATALOADER.NUM_WORKERS = train_settings["NUM_WORKERS"]
-cfg.MODEL.WEIGHTS = model_zoo.get_checkpoint_url("COCO-Detection/faster_rcnn_R_101_C4_3x.yaml")
-cfg.SOLVER.IMS_PER_BATCH = train_settings["IMS_PER_BATCH"]
-cfg.SOLVER.BASE_LR = train_settings["BASE_LR"]
-cfg.SOLVER.MAX_ITER = (train_settings["MAX_ITER"])
-cfg.SOLVER.WARMUP_ITERS = train_settings["WARMUP_ITERS"]
-cfg.SOLVER.STEPS = tuple(train_settings["STEPS"])
-cfg.SOLVER.GAMMA = train_settings["GAMMA"]
-cfg.MODEL.ROI_HEADS.BATCH_SIZE_PER_IMAGE = (train_settings["BATCH_SIZE_PER_IMAGE"])
-cfg.MODEL.ROI_HEADS.NUM_CLASSES = len(my_dataset.thing_classes)  # Number of classes is variable.
-cfg.OUTPUT_DIR = train_output_directory # User set output directory (under ./output/)
-
-# Setting up the output directory:
-os.makedirs(cfg.OUTPUT_DIR, exist_ok=True) # Creating the output directory
-with open(cfg_file_output, "w") as f: f.write(cfg.dump()) # Saving the CFG file (may be useful in the future)
-
-# Training our neural newtwork:
-trainer = DefaultTrainer(cfg)
-trainer.resume_or_load(resume=False)
-trainer.train()
+class Trainer(DefaultTrainer):
+
+    # Same as `DefaultTrainer`, but it can read the images from a pre-decoded `ImageCache`
+    # and group the batches by image size with a `BucketedBatchSampler`
+
+    image_cache = None # Set before building the trainer to skip the JPEG decoding
+    batch_sampler = None # Set before building the trainer to batch images of similar sizes
+
+    @classmethod
+    def build_train_loader(cls, cfg):
+        if cls.image_cache is None and cls.batch_sampler is None:
+            return super().build_train_loader(cfg)
+
+        if cls.image_cache is None:
+            mapper = DatasetMapper(cfg, is_train=True)
+        else:
+            mapper = CachedDatasetMapper(cfg, cls.image_cache, is_train=True)
+
+        if cls.batch_sampler is None:
+            return build_detection_train_loader(cfg, mapper=mapper)
+        return build_bucketed_train_loader(
+            DatasetCatalog.get(dataset_name), mapper, cls.batch_sampler, cfg.DATALOADER.NUM_WORKERS
+        )
+
+def register_dataset(dataset_info_file_path, use_cache, rebuild_cache, selection=None):
+
+    # Importing our dataset:
+    train_dataset = Dataset(dataset_info_file_path, "TRAIN", use_cache=use_cache, rebuild_cache=rebuild_cache)
+
+    # Keeping only a slice of the dataset, e.g. for smoke runs (`selection` : keyword arguments of `Dataset.select`):
+    if selection:
+        train_dataset = train_dataset.select(**selection)
+
+    # Inserting our dataset into the DatasetCatalog (necessary if we want to use it)
+    my_dataset = train_dataset.register(dataset_name)
+
+    """
+    The following commented code is for testing purposes only,
+    it allows us to verify if everything is alright with our dataset register.
+    """
+    """
+    import random, cv2
+    from detectron2.utils.visualizer import Visualizer
+    dataset_dicts = DatasetCatalog.get(dataset_name)
+    for d in random.sample(dataset_dicts, 3):
+        img = cv2.imread(d["file_name"])
+        visualizer = Visualizer(img[:, :, ::-1], metadata=my_dataset, scale=0.5)
+        vis = visualizer.draw_dataset_dict(d)
+        cv2.imwrite("myimage.jpg", vis.get_image()[:, :, ::-1])
+    """
+
+    return train_dataset, my_dataset
+
+def setup_cfg(train_settings, my_dataset):
+
+    # Defining the output directory:
+    default_output_directory = "./output" # Every output will be under './output'.
+    user_set_output_directory = train_settings["OUTPUT_DIR"]
+    train_output_directory = os.path.join(default_output_directory, user_set_output_directory)
+
+    # Setting up the CFG:
+    cfg = get_cfg()
+    cfg.merge_from_file(model_zoo.get_config_file("COCO-Detection/faster_rcnn_R_101_C4_3x.yaml"))
+    cfg.DATASETS.TRAIN = (dataset_name, )
+    cfg.DATASETS.TEST = () # No test dataset in use right now
+    cfg.DATALOADER.NUM_WORKERS = train_settings["NUM_WORKERS"]
+    cfg.MODEL.WEIGHTS = model_zoo.get_checkpoint_url("COCO-Detection/faster_rcnn_R_101_C4_3x.yaml")
+    cfg.SOLVER.IMS_PER_BATCH = train_settings["IMS_PER_BATCH"]
+    cfg.SOLVER.BASE_LR = train_settings["BASE_LR"]
+    cfg.SOLVER.MAX_ITER = (train_settings["MAX_ITER"])
+    cfg.SOLVER.WARMUP_ITERS = train_settings["WARMUP_ITERS"]
+    cfg.SOLVER.STEPS = tuple(train_settings["STEPS"])
+    cfg.SOLVER.GAMMA = train_settings["GAMMA"]
+    cfg.MODEL.ROI_HEADS.BATCH_SIZE_PER_IMAGE = (train_settings["BATCH_SIZE_PER_IMAGE"])
+    cfg.MODEL.ROI_HEADS.NUM_CLASSES = len(my_dataset.thing_classes)  # Number of classes is variable.
+    cfg.OUTPUT_DIR = train_output_directory # User set output directory (under ./output/)
+
+    return cfg
+
+def main(args):
+
+    # Getting the path to configuration files (from command-line):
+    dataset_info_file_path = args[1] # This file will allow us to configure the dataset
+    train_info_file_path = args[2] # This file will allow us to configure the train
+    use_cache = "--no-cache" not in args # Parses the CSV again without touching the dataset cache
+    rebuild_cache = "--rebuild-cache" in args # Parses the CSV again and overwrites the dataset cache
+
+    selection = get_selection(args) # "--categories A,B", "--path-prefix P", "--sample N"
+
+    train_dataset, my_dataset = register_dataset(dataset_info_file_path, use_cache, rebuild_cache, selection)
+
+    # Opening the train configuration file:
+    with open(train_info_file_path, "r") as f:
+        train_settings = json.load(f)
+
+    cfg = setup_cfg(train_settings, my_dataset)
+
+    # Setting the CFG file output path:
+    cfg_file_output = os.path.join(cfg.OUTPUT_DIR, "cfg.yaml")
+
+    # Setting up the output directory:
+    os.makedirs(cfg.OUTPUT_DIR, exist_ok=True) # Creating the output directory
+    with open(cfg_file_output, "w") as f: f.write(cfg.dump()) # Saving the CFG file (may be useful in the future)
+
+    # Batching images of similar sizes (needs the real size of every image):
+    if train_settings.get("BUCKETED_BATCHES"):
+        if train_dataset.channels is None: # Not read yet (see "probe_sizes" in `dataset_info.json`)
+            train_dataset.read_image_sizes()
+        Trainer.batch_sampler = BucketedBatchSampler(
+            train_dataset.widths, train_dataset.heights, cfg.SOLVER.IMS_PER_BATCH,
+            min_size=max(cfg.INPUT.MIN_SIZE_TRAIN), max_size=cfg.INPUT.MAX_SIZE_TRAIN,
+            step=train_settings.get("BUCKET_STEP", 64)
+        )
+        Trainer.batch_sampler.padding_report()
+
+    # Decoding every image once into a memory-mapped cache (optional):
+    if train_settings.get("IMAGE_CACHE"):
+        resize = train_settings.get("IMAGE_CACHE_RESIZE", True) # Resizing the images to the training input size
+        Trainer.image_cache = load_or_build_image_cache(
+            train_dataset.get(), train_settings["IMAGE_CACHE"],
+            min_size=max(cfg.INPUT.MIN_SIZE_TRAIN) if resize else None,
+            max_size=cfg.INPUT.MAX_SIZE_TRAIN if resize else None,
+            workers=max(cfg.DATALOADER.NUM_WORKERS, 1),
+            rebuild=rebuild_cache
+        )
+
+    # Training our neural newtwork:
+    trainer = Trainer(cfg)
+    if train_settings.get("PROFILE_THROUGHPUT", False):
+        trainer.register_hooks([ThroughputHook(cfg.OUTPUT_DIR)]) # Writes `throughput.jsonl`, AMP or not
+    trainer.resume_or_load(resume=False)
+    trainer.train()
+
+if __name__ == "__main__":
+    main(sys.argv)